@@ -3,8 +3,6 @@ from src.data_processing import *
 
 from src.helper import *
 
-from scipy.ndimage import generic_filter
-
 
 
 def main():
@@ -0,0 +1,559 @@
+"""
+Command line interface for the processing pipeline.
+
+    python -m src.cli index --tile T28RBS --year 2019 --window lapalma -w 4
+    python -m src.cli timeseries --tile T28RBS --year 2019 --window lapalma
+    python -m src.cli cluster --year 2021 --max-cloud 10 --window lapalma
+    python -m src.cli composite --tile T28RBS --year 2019 --period season
+    python -m src.cli render results/rasters/lapalma -w 8
+
+Intermediate products are cached under --cache-dir/<window> and reused by
+later commands; existing outputs are skipped unless --force is given.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from src.helper import lookup
+
+PROJECT_ROOT = Path(__file__).parents[1]
+INDICES = ('savi', 'ndvi', 'ndwi', 'nbr')
+# indices Timeseries can calculate; nbr is on the 20m grid
+TIMESERIES_INDICES = ('savi', 'ndvi', 'ndwi')
+# StreamingStatistics.AVAILABLE and ZonalStatistics.AVAILABLE, kept here so
+# the parser does not import the processing modules
+STATISTICS = ('count', 'mean', 'std', 'var', 'min', 'max', 'percentiles')
+ZONAL_STATISTICS = ('count', 'mean', 'std', 'percentiles')
+# full Sentinel-2 tile at 10 m
+TILE_PIXELS = 10980 * 10980
+
+
+def _progress(counter, total, message):
+    print(f'[{counter}/{total}] {message}', flush=True)
+
+
+def _parse_memory(value):
+    """Parses sizes like 512M, 4G or plain bytes"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMGT]?)B?', value.upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f'Invalid memory size {value}')
+    factor = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30,
+              'T': 2 ** 40}[match.group(2)]
+    return int(float(match.group(1)) * factor)
+
+
+def _parse_window(value):
+    if value is None or value in lookup.windows:
+        return value
+    parts = value.split(',')
+    if len(parts) != 4:
+        raise argparse.ArgumentTypeError(
+            'Window must be a name or col_off,row_off,width,height')
+    return [int(part) for part in parts]
+
+
+def _window_name(window):
+    if window is None:
+        return 'full'
+    if isinstance(window, str):
+        return window
+    return '_'.join(str(part) for part in window)
+
+
+def _window_pixels(window):
+    if window is None:
+        return TILE_PIXELS
+    from src.data_processing import RasterCalculator
+
+    calculator = RasterCalculator('data/processed', results_folder='')
+    calculator.set_borders(window)
+    return int(calculator.borders.width * calculator.borders.height)
+
+
+def _cache_dir(args):
+    cache_dir = Path(args.cache_dir)
+    if not cache_dir.is_absolute():
+        cache_dir = PROJECT_ROOT / cache_dir
+    return cache_dir / _window_name(args.window)
+
+
+def _save_options(args):
+    options = {}
+    if args.compress:
+        options['compress'] = args.compress
+        options['tiled'] = True
+    return options
+
+
+def _dates(args, required=True):
+    if args.dates:
+        return args.dates
+    if args.max_cloud is not None or args.min_valid is not None:
+        return _inventory_dates(args)
+    if args.year:
+        dates = getattr(lookup, f'year{args.year}', None)
+        if dates is None:
+            print(f'No date list for {args.year} in src/helper/lookup.py, '
+                  f'using the scene inventory')
+            return _inventory_dates(args)
+        return list(dates)
+    if required:
+        sys.exit('Select dates with --dates, --year or --max-cloud')
+    return None
+
+
+def _inventory_dates(args):
+    from src.data_processing import SceneInventory
+
+    inventory = SceneInventory()
+    inventory.scan(workers=args.workers or 4)
+    dates = inventory.query(args.tile, year=args.year,
+                            max_cloud=args.max_cloud, window=args.window,
+                            min_valid=args.min_valid)
+    inventory.close()
+    if not dates:
+        sys.exit('No scenes in the inventory match the selection')
+    print(f'Selected {len(dates)} scenes from the inventory: '
+          f'{" ".join(dates)}')
+    # later calls of _dates reuse the selection
+    args.dates = dates
+    return dates
+
+
+def _workers(args, bytes_per_task):
+    """Caps the worker count so that the tasks fit into --max-memory"""
+    workers = args.workers or os.cpu_count() or 1
+    if args.max_memory:
+        fitting = max(args.max_memory // max(bytes_per_task, 1), 1)
+        if fitting < workers:
+            print(f'Limiting to {fitting} workers for --max-memory')
+            workers = int(fitting)
+    return workers
+
+
+def _check_memory(args, required, what):
+    if args.max_memory and required > args.max_memory:
+        print(f'Warning: {what} needs about {required / 2 ** 30:.1f} GiB, '
+              f'more than --max-memory; use a smaller --window')
+
+
+# ---------------------------------------------------------------- commands
+
+def _list_dates(args):
+    processed = PROJECT_ROOT / args.processed
+    tiles = [args.tile] if args.tile else sorted(
+        path.name for path in processed.glob('*') if path.is_dir())
+    for tile in tiles:
+        dates = sorted(path.name for path in (processed / tile).glob('*')
+                       if path.is_dir())
+        print(f'{tile}: {" ".join(dates)}')
+
+
+def _inventory(args):
+    from src.data_processing import SceneInventory
+
+    inventory = SceneInventory(processed_path=args.processed,
+                               raw_path=args.raw)
+    inventory.scan(workers=args.workers or 4, force=args.force)
+    inventory.summary(args.tile, args.window)
+    inventory.close()
+
+
+def _ingest_task(raw_path, processed_path, safe_file):
+    from src.data_processing import SentinelProcessor
+
+    processor = SentinelProcessor(raw_path, processed_path)
+    processor.extract(safe_file)
+    return safe_file
+
+
+def _ingest(args):
+    from src.data_processing import SentinelProcessor
+
+    raw = PROJECT_ROOT / args.raw
+    processed = PROJECT_ROOT / args.processed
+    processor = SentinelProcessor(raw, processed)
+    safe_files = []
+    for safe_file in processor.find_safe_files():
+        tile, date, _ = processor.parse_safe_name(safe_file)
+        if (processed / tile / date).exists() and not args.force:
+            print(f'Skipping {safe_file}, already extracted')
+            continue
+        safe_files.append(safe_file)
+
+    workers = _workers(args, 0)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_ingest_task, raw, processed, safe_file)
+                   for safe_file in safe_files]
+        for counter, future in enumerate(as_completed(futures), start=1):
+            _progress(counter, len(futures), f'extracted {future.result()}')
+
+
+def _index_task(tile, date, index, window, cache_dir, save_options):
+    from src.data_processing import RasterCalculator
+
+    calculator = RasterCalculator('data/processed', results_folder=cache_dir,
+                                  save_options=save_options)
+    if window is not None:
+        calculator.set_borders(window)
+    method = getattr(calculator, f'calculate_{index}')
+    method(tile, date, save_file=True, use_bounds=window is not None)
+    return date
+
+
+def _index(args):
+    cache_dir = _cache_dir(args)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    dates = _dates(args)
+    missing = [date for date in dates if args.force or not
+               (cache_dir / f'{args.tile}_{date}_{args.index}.tif').exists()]
+    print(f'{len(dates) - len(missing)} of {len(dates)} dates cached in '
+          f'{cache_dir}')
+    if not missing:
+        return
+
+    # two float64 bands plus temporaries per task
+    workers = _workers(args, _window_pixels(args.window) * 8 * 6)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_index_task, args.tile, date, args.index,
+                                   args.window, cache_dir, _save_options(args))
+                   for date in missing]
+        for counter, future in enumerate(as_completed(futures), start=1):
+            _progress(counter, len(futures),
+                      f'{args.index} {future.result()}')
+
+
+def _composite(args):
+    from src.data_processing import Compositor
+
+    compositor = Compositor(args.tile, args.processed,
+                            workers=args.workers)
+    dates = _dates(args, required=False) or compositor.available_dates()
+    labels = compositor.composite_periods(dates, args.period, args.method,
+                                          min_dates=args.min_dates,
+                                          force=args.force)
+    # composite labels are used like dates by the other commands
+    print(f'Composites: {" ".join(labels)}')
+
+
+def _timeseries_object(args):
+    from src.data_processing import Timeseries
+
+    if args.window is None:
+        sys.exit('Time series commands need a --window')
+    return Timeseries(args.tile, _dates(args), bounds=args.window,
+                      save_options=_save_options(args),
+                      cache_dir=_cache_dir(args))
+
+
+def _output_path(args, dates, suffix, extension='.tif'):
+    from src.data_processing.timeseries import analysis_path
+
+    # Timeseries writes relative to the working directory
+    return Path('results') / analysis_path(dates, suffix, args.window,
+                                           extension)
+
+
+def _matrix_memory(args):
+    return _window_pixels(args.window) * len(_dates(args)) * 8 * 2
+
+
+def _timeseries(args):
+    dates = _dates(args)
+    names = [name for statistic in args.statistics for name in
+             (('p10', 'p50', 'p90') if statistic == 'percentiles'
+              else (statistic,))]
+    outputs = [_output_path(args, dates, f'{args.index}_{name}')
+               for name in names]
+    if all(path.exists() for path in outputs) and not args.force:
+        print('Statistics already calculated, use --force to redo')
+        return
+    timeseries = _timeseries_object(args)
+    timeseries.calculate_statistics(args.index, tuple(args.statistics),
+                                    save_file=True)
+
+
+def _cluster(args):
+    dates = _dates(args)
+    if (_output_path(args, dates, f'{args.index}_clusters').exists()
+            and not args.force):
+        print('Clusters already calculated, use --force to redo')
+        return
+    _check_memory(args, _matrix_memory(args), 'the time series matrix')
+    timeseries = _timeseries_object(args)
+    timeseries.create_timeseries_matrix(args.index, workers=args.workers or 1)
+    timeseries.create_clusters_matrix(args.n_clusters, save_raster=True,
+                                      sample_size=args.sample_size,
+                                      workers=args.workers or 1)
+    timeseries.release_shared()
+
+
+def _trend(args):
+    dates = _dates(args)
+    if (_output_path(args, dates, f'{args.index}_slopes').exists()
+            and not args.force):
+        print('Slopes already calculated, use --force to redo')
+        return
+    _check_memory(args, _matrix_memory(args), 'the time series matrix')
+    timeseries = _timeseries_object(args)
+    timeseries.create_timeseries_matrix(args.index, workers=args.workers or 1)
+    timeseries.calculate_slopes(save_raster=True)
+
+
+def _zonal(args):
+    from src.helper import RasterData
+
+    dates = _dates(args)
+    output = _output_path(args, dates, f'{args.index}_zones', '.csv')
+    if output.exists() and not args.force:
+        print('Zonal statistics already calculated, use --force to redo')
+        return
+    timeseries = _timeseries_object(args)
+    if Path(args.zones).suffix.lower() in ('.json', '.geojson'):
+        timeseries.zonal_statistics(args.zones, args.index,
+                                    tuple(args.statistics), save_file=True)
+    else:
+        # label raster on the grid of the window, e.g. the cluster output
+        zones = RasterData(source=args.zones)
+        timeseries.zonal_statistics(zones, args.index,
+                                    tuple(args.statistics), save_file=True,
+                                    ignore=args.ignore)
+    print(f'Wrote {output}')
+
+
+def _filter(args):
+    from src.data_processing import SpatialFilter
+    from src.helper import RasterData
+
+    source = Path(args.raster)
+    output = source.with_name(f'{source.stem}_{args.filter}{args.size}.tif')
+    if output.exists() and not args.force:
+        print(f'{output} exists, use --force to redo')
+        return
+    raster = RasterData(source=str(source))
+    spatial_filter = SpatialFilter(workers=args.workers or 1)
+    if args.filter == 'majority':
+        result = spatial_filter.majority_filter(raster, args.size)
+    elif args.filter == 'mean':
+        result = spatial_filter.focal_mean(raster, args.size)
+    elif args.filter == 'std':
+        result = spatial_filter.focal_std(raster, args.size)
+    else:
+        result, _ = spatial_filter.recovery_patches(
+            raster, args.threshold, args.size, args.min_pixels)
+    result.save(output, results_folder=None, **_save_options(args))
+    print(f'Wrote {output}')
+
+
+def _dem_prepare(args):
+    from src.data_processing import DEMProcessor
+    from src.helper import RasterData, RasterType
+
+    output_dir = PROJECT_ROOT / args.output
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (Path.cwd() / 'temp').mkdir(exist_ok=True)
+    sources = [Path(source) for source in args.sources]
+    todo = [source for source in sources if args.force or not
+            (output_dir / f'{source.stem}_prepared.tif').exists()]
+    if not todo:
+        print('All DEM files already prepared')
+        return
+    rasters = tuple(RasterData(source=str(source),
+                               rastertype=RasterType.ELEVATION)
+                    for source in todo)
+    processor = DEMProcessor(args.crs, rasters)
+    for counter, (source, raster) in enumerate(
+            zip(todo, processor.prepare_rasters()), start=1):
+        raster.save(output_dir / f'{source.stem}_prepared.tif',
+                    results_folder=None, **_save_options(args))
+        _progress(counter, len(todo), f'prepared {source.name}')
+
+
+def _dem_merge(args):
+    from src.data_processing import DEMProcessor
+    from src.helper import RasterData, RasterType
+
+    output = PROJECT_ROOT / args.output
+    if output.exists() and not args.force:
+        print(f'{output} exists, use --force to redo')
+        return
+    rasters = tuple(RasterData(source=str(source),
+                               rastertype=RasterType.ELEVATION)
+                    for source in (args.first, args.second))
+    merged = DEMProcessor(rasters[0].meta['crs'], rasters).merge_rasters(0, 1)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    merged.save(output, results_folder=None, **_save_options(args))
+
+
+def _render(args):
+    from src.visualization import atlas_jobs, render_batch
+
+    output_dir = PROJECT_ROOT / args.output
+    jobs = atlas_jobs(args.directory, args.pattern)
+    if not args.force:
+        jobs = [job for job in jobs
+                if not (output_dir / f'{job["name"]}.png').exists()]
+    print(f'Rendering {len(jobs)} figures to {output_dir}')
+    if jobs:
+        render_batch(jobs, workers=_workers(args, 256 * 2 ** 20),
+                     output_dir=output_dir)
+
+
+# ------------------------------------------------------------------ parser
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-w', '--workers', type=int, default=None,
+                        help='worker processes, default: CPU count')
+    common.add_argument('--window', type=_parse_window, default=None,
+                        help='named window (lapalma, lavaflow_lapalma) or '
+                             'col_off,row_off,width,height')
+    common.add_argument('--cache-dir', default='results/rasters',
+                        help='where intermediate index rasters are cached')
+    common.add_argument('--max-memory', type=_parse_memory, default=None,
+                        help='memory budget, e.g. 8G; limits workers')
+    common.add_argument('--compress', choices=('deflate', 'zstd', 'lzw'),
+                        default=None, help='compress written rasters')
+    common.add_argument('--force', action='store_true',
+                        help='recompute outputs that already exist')
+
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument('--tile', default='T28RBS')
+    selection.add_argument('--dates', nargs='+', default=None)
+    selection.add_argument('--year', default=None,
+                           help='use the date list of src/helper/lookup.py')
+    selection.add_argument('--max-cloud', type=float, default=None,
+                           help='select scenes from the inventory with at '
+                                'most this cloud cover in percent (over '
+                                '--window if given)')
+    selection.add_argument('--min-valid', type=float, default=None,
+                           help='select scenes from the inventory with at '
+                                'least this clear fraction (0..1)')
+
+    parser = argparse.ArgumentParser(prog='python -m src.cli',
+                                     description='Volcanic recovery analysis')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    dates = commands.add_parser('dates', help='list processed dates')
+    dates.add_argument('--tile', default=None)
+    dates.add_argument('--processed', default='data/processed')
+    dates.set_defaults(func=_list_dates)
+
+    ingest = commands.add_parser('ingest', parents=[common],
+                                 help='extract bands from SAFE folders')
+    ingest.add_argument('--raw', default='data/raw')
+    ingest.add_argument('--processed', default='data/processed')
+    ingest.set_defaults(func=_ingest)
+
+    inventory = commands.add_parser(
+        'inventory', parents=[common],
+        help='scan scenes and SAFE metadata into data/inventory.sqlite')
+    inventory.add_argument('--tile', default='T28RBS')
+    inventory.add_argument('--raw', default='data/raw')
+    inventory.add_argument('--processed', default='data/processed')
+    inventory.set_defaults(func=_inventory)
+
+    index = commands.add_parser('index', parents=[common, selection],
+                                help='calculate and cache index rasters')
+    index.add_argument('--index', choices=INDICES, default='savi')
+    index.set_defaults(func=_index)
+
+    composite = commands.add_parser(
+        'composite', parents=[common, selection],
+        help='cloud-free composites per month, season or year; the labels '
+             'can be passed to --dates of the other commands')
+    composite.add_argument('--period', choices=('month', 'season', 'year'),
+                           default='month')
+    composite.add_argument('--method',
+                           choices=('median', 'max_ndvi', 'best_pixel'),
+                           default='median')
+    composite.add_argument('--min-dates', type=int, default=1)
+    composite.add_argument('--processed', default='data/processed')
+    composite.set_defaults(func=_composite)
+
+    timeseries = commands.add_parser('timeseries',
+                                     parents=[common, selection],
+                                     help='per-pixel statistics over dates')
+    timeseries.add_argument('--statistics', nargs='+', choices=STATISTICS,
+                            default=['mean', 'std'])
+    timeseries.add_argument('--index', choices=TIMESERIES_INDICES,
+                            default='savi')
+    timeseries.set_defaults(func=_timeseries)
+
+    cluster = commands.add_parser('cluster', parents=[common, selection],
+                                  help='KMeans clusters of pixel series')
+    cluster.add_argument('-k', '--n-clusters', type=int, default=5)
+    cluster.add_argument('--sample-size', type=int, default=None)
+    cluster.add_argument('--index', choices=TIMESERIES_INDICES,
+                         default='savi')
+    cluster.set_defaults(func=_cluster)
+
+    trend = commands.add_parser('trend', parents=[common, selection],
+                                help='per-pixel linear trend')
+    trend.add_argument('--index', choices=TIMESERIES_INDICES,
+                       default='savi')
+    trend.set_defaults(func=_trend)
+
+    zonal = commands.add_parser('zonal', parents=[common, selection],
+                                help='statistics per zone and date as CSV')
+    zonal.add_argument('zones',
+                       help='label raster of the window or GeoJSON polygons')
+    zonal.add_argument('--statistics', nargs='+', choices=ZONAL_STATISTICS,
+                       default=['count', 'mean', 'std'])
+    zonal.add_argument('--ignore', type=int, default=None,
+                       help='zone value to leave out, e.g. background')
+    zonal.add_argument('--index', choices=TIMESERIES_INDICES,
+                       default='savi')
+    zonal.set_defaults(func=_zonal)
+
+    spatial = commands.add_parser(
+        'filter', parents=[common],
+        help='majority, focal mean/std or recovery patches of a raster')
+    spatial.add_argument('raster')
+    spatial.add_argument('filter',
+                         choices=('majority', 'mean', 'std', 'patches'))
+    spatial.add_argument('--size', type=int, default=3,
+                         help='odd neighbourhood size')
+    spatial.add_argument('--threshold', type=float, default=0.0,
+                         help='patches: smoothed value a pixel must exceed')
+    spatial.add_argument('--min-pixels', type=int, default=25)
+    spatial.set_defaults(func=_filter)
+
+    dem = commands.add_parser('dem', help='DEM preparation')
+    dem_commands = dem.add_subparsers(dest='dem_command', required=True)
+    prepare = dem_commands.add_parser('prepare', parents=[common],
+                                      help='clean and reproject DEM files')
+    prepare.add_argument('sources', nargs='+')
+    prepare.add_argument('--crs', required=True)
+    prepare.add_argument('--output', default='data/DEM_finished')
+    prepare.set_defaults(func=_dem_prepare)
+    merge = dem_commands.add_parser('merge', parents=[common],
+                                    help='merge two prepared DEM files')
+    merge.add_argument('first')
+    merge.add_argument('second')
+    merge.add_argument('--output', default='data/DEM_merged/merged.tif')
+    merge.set_defaults(func=_dem_merge)
+
+    render = commands.add_parser('render', parents=[common],
+                                 help='render rasters of a directory to PNG')
+    render.add_argument('directory')
+    render.add_argument('--pattern', default='*.tif')
+    render.add_argument('--output', default='results/figures')
+    render.set_defaults(func=_render)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    start = time.perf_counter()
+    args.func(args)
+    print(f'Finished {args.command} in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
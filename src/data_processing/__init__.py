@@ -1,4 +1,32 @@
-from .sentinel_processor import SentinelProcessor
-from .raster_calculator import RasterCalculator
-from .dem_processing import *
-from .timeseries import Timeseries
\ No newline at end of file
+from importlib import import_module
+
+# Classes are imported on first access, so importing the package (e.g. for
+# the CLI) does not load scipy, sklearn and the rest until they are needed.
+_exports = {
+    'SentinelProcessor': '.sentinel_processor',
+    'RasterCalculator': '.raster_calculator',
+    'DEMProcessor': '.dem_processing',
+    'StreamingStatistics': '.streaming_statistics',
+    'Timeseries': '.timeseries',
+    'PixelQuery': '.pixel_query',
+    'serve_pixel_queries': '.pixel_query',
+    'ChangeDetector': '.change_detection',
+    'Compositor': '.compositing',
+    'ZonalStatistics': '.zonal_statistics',
+    'SpatialFilter': '.spatial_filters',
+    'SceneInventory': '.scene_inventory',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,369 @@
+import json
+import tempfile
+import warnings
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.features import shapes
+from rasterio.windows import Window
+
+from src.helper import *
+
+# USGS (Key & Benson) dNBR severity classes, upper bounds of each class
+SEVERITY_BOUNDS = (-0.25, -0.1, 0.1, 0.27, 0.44, 0.66)
+SEVERITY_LABELS = (
+    'enhanced regrowth, high',
+    'enhanced regrowth, low',
+    'unchanged',
+    'low severity',
+    'moderate-low severity',
+    'moderate-high severity',
+    'high severity',
+)
+SEVERITY_NODATA = 255
+
+# bands, resolution and scale of the 10m window for every index
+INDEX_BANDS = {
+    'savi': (('04', '08'), '10m', 1),
+    'ndvi': (('04', '08'), '10m', 1),
+    'nbr': (('8A', '12'), '20m', 2),
+}
+
+
+def _index_from_bands(index, first, second, L=0.5):
+    """Same formulas as RasterCalculator; pixels without data become NaN"""
+    first = np.clip(first / 10000, 0, 1).astype(np.float32)
+    second = np.clip(second / 10000, 0, 1).astype(np.float32)
+    total = first + second
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if index == 'savi':
+            red, nir = first, second
+            values = (nir - red) / (total + L) * (1 + L)
+        elif index == 'ndvi':
+            red, nir = first, second
+            values = (nir - red) / total
+        else:
+            nir, swir = first, second
+            values = (nir - swir) / total
+    values[total == 0] = np.nan
+    return values
+
+
+class ChangeDetector:
+    """
+    ChangeDetector: Block-wise comparison of two sets of dates
+
+    Each side (e.g. all scenes before and after the eruption) is reduced to
+    a per-pixel median or mean composite and the difference pre - post is
+    written block by block, so memory depends on the block size and the
+    number of dates, not on the raster size. Positive values mean a loss of
+    vegetation (dNBR / dSAVI convention).
+
+    Arguments:
+        - tile: Tile to examine
+        - band_dir: Directory of the extracted bands, relative to the project
+        - output_dir: Directory the change rasters are written to
+        - bounds: Optional window (name from lookup.windows or tuple) on the
+          10m grid
+        - block_size: Edge length of the processed blocks, multiple of 16
+    """
+
+    def __init__(self, tile, band_dir='data/processed',
+                 output_dir='results/change', bounds=None, block_size=512):
+        self.tile = tile
+        self.band_dir = Path(__file__).parents[2] / band_dir
+        self.output_dir = Path(output_dir)
+        if not self.output_dir.is_absolute():
+            self.output_dir = Path(__file__).parents[2] / self.output_dir
+        if isinstance(bounds, str):
+            bounds = windows[bounds]
+        self.bounds = bounds
+        self.block_size = block_size
+        self._datasets = {}
+
+    def _band_path(self, date, band, resolution):
+        directory = self.band_dir / self.tile / date / f'R{resolution}'
+        matches = [path for path in directory.glob('*.jp2')
+                   if f'B{band}' in path.name]
+        matches += [path for path in directory.glob('*.tif')
+                    if f'B{band}' in path.name]
+        if not matches:
+            raise FileNotFoundError(f'No B{band} {resolution} band for '
+                                    f'{self.tile} {date} in {directory}')
+        return matches[0]
+
+    def _dataset(self, date, band, resolution):
+        key = (date, band, resolution)
+        if key not in self._datasets:
+            self._datasets[key] = rasterio.open(
+                self._band_path(date, band, resolution))
+        return self._datasets[key]
+
+    def _area(self, index, reference):
+        """Area of interest as a window on the index resolution"""
+        scale = INDEX_BANDS[index][2]
+        if self.bounds is None:
+            return Window(0, 0, reference.width, reference.height)
+        col_off, row_off, width, height = self.bounds
+        return Window(col_off // scale, row_off // scale,
+                      width // scale, height // scale)
+
+    def _blocks(self, area):
+        for row in range(0, int(area.height), self.block_size):
+            for col in range(0, int(area.width), self.block_size):
+                yield Window(col, row,
+                             min(self.block_size, int(area.width) - col),
+                             min(self.block_size, int(area.height) - row))
+
+    def index_block(self, index, date, window):
+        bands, resolution, _ = INDEX_BANDS[index]
+        first = self._dataset(date, bands[0], resolution).read(1, window=window)
+        second = self._dataset(date, bands[1], resolution).read(1, window=window)
+        return _index_from_bands(index, first, second)
+
+    def composite_block(self, index, dates, window, method='median'):
+        """Per-pixel median or mean of an index over dates, ignoring NaN"""
+        stack = np.stack([self.index_block(index, date, window)
+                          for date in dates])
+        with warnings.catch_warnings():
+            # pixels without data on every date stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if method == 'median':
+                return np.nanmedian(stack, axis=0)
+            elif method == 'mean':
+                return np.nanmean(stack, axis=0)
+        raise ValueError(f'Unknown composite method {method}')
+
+    def compare(self, pre_dates, post_dates, index='nbr', method='median',
+                threshold=0.1, class_bounds=SEVERITY_BOUNDS, name=None):
+        """
+        Writes the difference, severity class and change mask rasters
+        :param pre_dates: dates composited for the reference state
+        :param post_dates: dates composited for the compared state
+        :param index: 'nbr' (dNBR), 'savi' (dSAVI) or 'ndvi'
+        :param threshold: difference above which a pixel counts as changed
+        :param class_bounds: upper bounds of the severity classes
+        :return: dict with the output paths and per-class pixel counts
+        """
+        bands, resolution, _ = INDEX_BANDS[index]
+        reference = self._dataset(pre_dates[0], bands[0], resolution)
+        area = self._area(index, reference)
+        if name is None:
+            name = (f'{self.tile}_{pre_dates[0]}-{pre_dates[-1]}_'
+                    f'{post_dates[0]}-{post_dates[-1]}_d{index}')
+
+        profile = reference.profile.copy()
+        for key in ('blockxsize', 'blockysize', 'tiled', 'compress',
+                    'interleave', 'photometric'):
+            profile.pop(key, None)
+        profile.update({'driver': 'GTiff', 'count': 1,
+                        'width': int(area.width), 'height': int(area.height),
+                        'transform': rasterio.windows.transform(
+                            area, reference.transform),
+                        'tiled': True, 'blockxsize': self.block_size,
+                        'blockysize': self.block_size,
+                        'compress': 'deflate'})
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        paths = {'difference': self.output_dir / f'{name}.tif',
+                 'severity': self.output_dir / f'{name}_severity.tif',
+                 'mask': self.output_dir / f'{name}_mask.tif'}
+        class_counts = np.zeros(len(class_bounds) + 1, dtype=np.int64)
+
+        blocks = list(self._blocks(area))
+        with rasterio.open(paths['difference'], 'w',
+                           **{**profile, 'dtype': 'float32',
+                              'nodata': np.nan, 'predictor': 3}) as difference_dst, \
+                rasterio.open(paths['severity'], 'w',
+                              **{**profile, 'dtype': 'uint8',
+                                 'nodata': SEVERITY_NODATA}) as severity_dst, \
+                rasterio.open(paths['mask'], 'w',
+                              **{**profile, 'dtype': 'uint8',
+                                 'nodata': None}) as mask_dst:
+            for counter, block in enumerate(blocks, start=1):
+                source = Window(area.col_off + block.col_off,
+                                area.row_off + block.row_off,
+                                block.width, block.height)
+                pre = self.composite_block(index, pre_dates, source, method)
+                post = self.composite_block(index, post_dates, source, method)
+                difference = (pre - post).astype(np.float32)
+                valid = np.isfinite(difference)
+
+                severity = np.digitize(np.where(valid, difference, 0),
+                                       class_bounds).astype(np.uint8)
+                severity[~valid] = SEVERITY_NODATA
+                class_counts += np.bincount(severity[valid],
+                                            minlength=len(class_counts))
+                mask = (valid & (difference > threshold)).astype(np.uint8)
+
+                difference_dst.write(difference, 1, window=block)
+                severity_dst.write(severity, 1, window=block)
+                mask_dst.write(mask, 1, window=block)
+                if counter % 10 == 0 or counter == len(blocks):
+                    print(f'Compared block {counter}/{len(blocks)}')
+
+        pixel_area = abs(profile['transform'].a * profile['transform'].e)
+        summary = {label: {'pixels': int(count),
+                           'area_m2': float(count * pixel_area)}
+                   for label, count in zip(SEVERITY_LABELS
+                                           if len(class_counts) ==
+                                           len(SEVERITY_LABELS)
+                                           else range(len(class_counts)),
+                                           class_counts)}
+        return {'paths': paths, 'classes': summary}
+
+    def _label_blocks(self, mask_src, labels_dst):
+        """
+        Labels the patches of every mask block and writes them with labels
+        unique over the raster
+        :return: number of block labels
+        """
+        from scipy import ndimage
+
+        area = Window(0, 0, mask_src.width, mask_src.height)
+        count = 0
+        for window in self._blocks(area):
+            labels, block_count = ndimage.label(
+                mask_src.read(1, window=window).astype(bool),
+                structure=np.ones((3, 3)))
+            labels[labels > 0] += count
+            count += block_count
+            labels_dst.write(labels.astype(np.int32), 1, window=window)
+        return count
+
+    def _merge_seams(self, labels_src, count):
+        """
+        Maps block labels to patch labels 1..n by joining the labels that
+        touch (8-connected) across the block seams
+        :return: (relabel array indexed by block label, number of patches)
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        width, height = labels_src.width, labels_src.height
+        pairs = []
+        # a seam is read as two rows or columns, the cells on either side
+        seams = ([Window(0, row - 1, width, 2)
+                  for row in range(self.block_size, height, self.block_size)] +
+                 [Window(col - 1, 0, 2, height)
+                  for col in range(self.block_size, width, self.block_size)])
+        for window in seams:
+            seam = labels_src.read(1, window=window)
+            if window.width == 2:
+                seam = seam.T
+            first, second = seam
+            for shift in (0, 1, -1):
+                if shift == 0:
+                    pair = first, second
+                elif shift == 1:
+                    pair = first[:-1], second[1:]
+                else:
+                    pair = first[1:], second[:-1]
+                touching = (pair[0] > 0) & (pair[1] > 0)
+                pairs.append(np.stack([pair[0][touching],
+                                       pair[1][touching]]))
+        pairs = (np.concatenate(pairs, axis=1) if pairs
+                 else np.zeros((2, 0), dtype=np.int32))
+        graph = coo_matrix((np.ones(pairs.shape[1], dtype=np.int8),
+                            (pairs[0], pairs[1])),
+                           shape=(count + 1, count + 1))
+        _, components = connected_components(graph, directed=False)
+        # the background (0) is never joined, number the patches from 1
+        _, patches = np.unique(components[1:], return_inverse=True)
+        relabel = np.concatenate([[0], patches + 1]).astype(np.int32)
+        return relabel, int(relabel.max())
+
+    def change_polygons(self, paths, min_pixels=10, output=None):
+        """
+        Polygonizes the change mask and computes statistics of the
+        difference inside every polygon. Patches are labelled per block and
+        joined across the block seams in a label raster on disk, which is
+        polygonized by GDAL line by line, so memory depends on the block
+        size and the number of patches, not on the raster size.
+        :param paths: paths returned by compare()
+        :param min_pixels: drop patches smaller than this
+        :param output: optional GeoJSON path to write the polygons to
+        :return: list of dicts with geometry, pixels, area and statistics
+        """
+        with tempfile.TemporaryDirectory() as directory, \
+                rasterio.open(paths['mask']) as mask_src:
+            transform = mask_src.transform
+            crs = mask_src.crs
+            profile = mask_src.profile.copy()
+            for key in ('compress', 'predictor', 'interleave', 'photometric'):
+                profile.pop(key, None)
+            profile.update({'driver': 'GTiff', 'count': 1, 'dtype': 'int32',
+                            'nodata': None, 'tiled': True,
+                            'blockxsize': self.block_size,
+                            'blockysize': self.block_size})
+            labels_path = Path(directory) / 'labels.tif'
+            with rasterio.open(labels_path, 'w', **profile) as labels_dst:
+                block_count = self._label_blocks(mask_src, labels_dst)
+            with rasterio.open(labels_path) as labels_src:
+                relabel, count = self._merge_seams(labels_src, block_count)
+
+            pixels = np.zeros(count + 1, dtype=np.int64)
+            sums = np.zeros(count + 1)
+            squares = np.zeros(count + 1)
+            maxima = np.full(count + 1, -np.inf)
+            area = Window(0, 0, mask_src.width, mask_src.height)
+            with rasterio.open(labels_path, 'r+') as labels_dst, \
+                    rasterio.open(paths['difference']) as src:
+                for window in self._blocks(area):
+                    block_labels = relabel[labels_dst.read(1, window=window)]
+                    labels_dst.write(block_labels, 1, window=window)
+                    difference = src.read(1, window=window).astype(np.float64)
+                    valid = np.isfinite(difference)
+                    block_labels = np.where(valid, block_labels, 0).ravel()
+                    difference = np.where(valid, difference, 0).ravel()
+                    pixels += np.bincount(block_labels, minlength=count + 1)
+                    sums += np.bincount(block_labels, weights=difference,
+                                        minlength=count + 1)
+                    squares += np.bincount(block_labels,
+                                           weights=difference ** 2,
+                                           minlength=count + 1)
+                    np.maximum.at(maxima, block_labels, difference)
+
+            with rasterio.open(labels_path) as labels_src:
+                features = list(shapes(rasterio.band(labels_src, 1),
+                                       mask=rasterio.band(mask_src, 1),
+                                       connectivity=8, transform=transform))
+
+        pixel_area = abs(transform.a * transform.e)
+        polygons = []
+        for geometry, label in features:
+            label = int(label)
+            if pixels[label] < min_pixels:
+                continue
+            mean = sums[label] / pixels[label]
+            polygons.append({
+                'geometry': geometry,
+                'label': label,
+                'pixels': int(pixels[label]),
+                'area_m2': float(pixels[label] * pixel_area),
+                'mean': float(mean),
+                'std': float(np.sqrt(max(squares[label] / pixels[label]
+                                         - mean ** 2, 0))),
+                'max': float(maxima[label]),
+            })
+
+        if output is not None:
+            features = [{'type': 'Feature', 'geometry': polygon['geometry'],
+                         'properties': {key: value for key, value
+                                        in polygon.items()
+                                        if key != 'geometry'}}
+                        for polygon in polygons]
+            with open(output, 'w') as file:
+                json.dump({'type': 'FeatureCollection',
+                           'crs': {'type': 'name',
+                                   'properties': {'name': str(crs)}},
+                           'features': features}, file)
+        print(f'{len(polygons)} change polygons with at least {min_pixels} '
+              f'pixels')
+        return polygons
+
+    def close(self):
+        for dataset in self._datasets.values():
+            dataset.close()
+        self._datasets = {}
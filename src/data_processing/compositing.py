@@ -0,0 +1,298 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from src.helper import *
+
+# bands written for every composite, per resolution
+COMPOSITE_BANDS = {
+    '10m': ('02', '03', '04', '08'),
+    '20m': ('8A', '11', '12'),
+}
+SEASONS = {12: 'DJF', 1: 'DJF', 2: 'DJF', 3: 'MAM', 4: 'MAM', 5: 'MAM',
+           6: 'JJA', 7: 'JJA', 8: 'JJA', 9: 'SON', 10: 'SON', 11: 'SON'}
+METHODS = ('median', 'max_ndvi', 'best_pixel')
+
+
+def group_dates(dates, period='month'):
+    """
+    Groups capture dates into composite periods
+    :param dates: dates as YYYYMMDD strings
+    :param period: 'month', 'season' (December counts to the next year's
+        DJF) or 'year'
+    :return: dict of label (e.g. '2019-06', '2019-JJA', '2019-Y') to sorted
+        dates; labels are never all digits, so they cannot pass for a date
+    """
+    groups = {}
+    for date in sorted(dates):
+        year, month = int(date[:4]), int(date[4:6])
+        if period == 'month':
+            label = f'{year}-{month:02d}'
+        elif period == 'season':
+            label = f'{year + (month == 12)}-{SEASONS[month]}'
+        elif period == 'year':
+            label = f'{year}-Y'
+        else:
+            raise ValueError(f'Unknown period {period}')
+        groups.setdefault(label, []).append(date)
+    return groups
+
+
+def _nanmedian(stack):
+    """
+    Median over the first axis ignoring NaN. NaN sorts last, so only the
+    lower half of the stack has to be partitioned instead of fully sorted.
+    """
+    count = np.count_nonzero(~np.isnan(stack), axis=0)
+    ordered = np.partition(stack, list(range(stack.shape[0] // 2 + 1)),
+                           axis=0)
+    lower = np.take_along_axis(ordered, ((np.maximum(count, 1) - 1) // 2)
+                               [np.newaxis], axis=0)[0]
+    upper = np.take_along_axis(ordered, (count // 2).clip(
+        max=stack.shape[0] - 1)[np.newaxis], axis=0)[0]
+    median = (lower + upper) / 2
+    median[count == 0] = np.nan
+    return median
+
+
+class Compositor:
+    """
+    Compositor: Cloud-free composites of many Sentinel-2 scenes
+
+    Pixels flagged as cloud, shadow or no-data in the scene classification
+    (SCL) are masked before reducing the dates of a period per pixel:
+
+        - median: per-band median of the clear observations
+        - max_ndvi: all bands of the clear observation with the highest NDVI
+        - best_pixel: all bands of the clear observation with the lowest blue
+          reflectance, i.e. the least haze
+
+    Blocks of all dates are read and reduced as float32 in a thread pool and
+    written to data/processed/<tile>/<label>/R10m|R20m, so RasterCalculator
+    and Timeseries take a composite label wherever they take a date.
+
+    Arguments:
+        - tile: Tile to composite
+        - band_dir: Directory of the extracted bands, relative to the project
+        - block_size: Edge length of the 10m blocks, multiple of 32
+        - workers: Threads reducing blocks, default: CPU count
+        - valid_classes: SCL values treated as clear
+    """
+
+    def __init__(self, tile, band_dir='data/processed', block_size=512,
+                 workers=None, valid_classes=scl_valid):
+        if block_size % 32:
+            raise ValueError('block_size has to be a multiple of 32')
+        self.tile = tile
+        self.band_dir = Path(__file__).parents[2] / band_dir
+        self.block_size = block_size
+        self.workers = workers
+        self.valid_classes = np.asarray(valid_classes)
+        # rasterio datasets must not be shared between threads
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def available_dates(self):
+        """Extracted scenes of the tile, without composite labels"""
+        directory = self.band_dir / self.tile
+        return sorted(path.name for path in directory.glob('*')
+                      if path.is_dir() and len(path.name) == 8
+                      and path.name.isdigit())
+
+    def _band_path(self, date, band, resolution):
+        directory = self.band_dir / self.tile / date / f'R{resolution}'
+        name = band if band == 'SCL' else f'B{band}'
+        for pattern in ('*.jp2', '*.tif'):
+            for path in directory.glob(pattern):
+                if name in path.name:
+                    return path
+        return None
+
+    def _dataset(self, date, band, resolution):
+        datasets = getattr(self._local, 'datasets', None)
+        if datasets is None:
+            datasets = self._local.datasets = {}
+        key = (date, band, resolution)
+        if key not in datasets:
+            path = self._band_path(date, band, resolution)
+            if path is None:
+                if band == 'SCL':
+                    datasets[key] = None
+                    return None
+                raise FileNotFoundError(f'No B{band} {resolution} band for '
+                                        f'{self.tile} {date}')
+            datasets[key] = rasterio.open(path)
+            with self._lock:
+                self._opened.append(datasets[key])
+        return datasets[key]
+
+    def _close(self):
+        for dataset in self._opened:
+            dataset.close()
+        self._opened = []
+        self._local = threading.local()
+
+    def _clear(self, dates, window):
+        """Clear-sky mask of every date on the 20m grid"""
+        masks = []
+        for date in dates:
+            scl = self._dataset(date, 'SCL', '20m')
+            if scl is None:
+                masks.append(np.ones((int(window.height), int(window.width)),
+                                     dtype=bool))
+            else:
+                masks.append(np.isin(scl.read(1, window=window),
+                                     self.valid_classes))
+        return np.stack(masks)
+
+    def _composite_block(self, dates, method, window):
+        height, width = int(window.height), int(window.width)
+        reads = {'10m': window,
+                 '20m': Window(window.col_off // 2, window.row_off // 2,
+                               -(-width // 2), -(-height // 2))}
+        clear = {'20m': self._clear(dates, reads['20m'])}
+        clear['10m'] = clear['20m'].repeat(2, axis=1).repeat(
+            2, axis=2)[:, :height, :width]
+
+        stacks = {}
+
+        def stack(band, resolution):
+            if (band, resolution) not in stacks:
+                data = np.stack([
+                    self._dataset(date, band, resolution).read(
+                        1, window=reads[resolution])
+                    for date in dates]).astype(np.float32)
+                data[~clear[resolution] | (data == 0)] = np.nan
+                stacks[band, resolution] = data
+            return stacks[band, resolution]
+
+        if method == 'median':
+            return {(band, resolution): _nanmedian(stack(band, resolution))
+                    for resolution, bands in COMPOSITE_BANDS.items()
+                    for band in bands}
+
+        if method == 'max_ndvi':
+            red, nir = stack('04', '10m'), stack('08', '10m')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                score = (nir - red) / (nir + red)
+        else:
+            score = -stack('02', '10m')
+        score = np.where(np.isnan(score), -np.inf, score)
+        choice = {'10m': score.argmax(axis=0)[np.newaxis]}
+        empty = {'10m': np.isneginf(score).all(axis=0)}
+        # the 20m choice is the decimated 10m choice, its clear mask is the
+        # upsampled 20m one
+        choice['20m'] = choice['10m'][:, ::2, ::2]
+        empty['20m'] = empty['10m'][::2, ::2]
+
+        results = {}
+        for resolution, bands in COMPOSITE_BANDS.items():
+            for band in bands:
+                values = np.take_along_axis(stack(band, resolution),
+                                            choice[resolution], axis=0)[0]
+                values[empty[resolution]] = np.nan
+                results[band, resolution] = values
+        return results
+
+    def _blocks(self, width, height):
+        for row in range(0, height, self.block_size):
+            for col in range(0, width, self.block_size):
+                yield Window(col, row, min(self.block_size, width - col),
+                             min(self.block_size, height - row))
+
+    def output_path(self, label, band, resolution):
+        return (self.band_dir / self.tile / label / f'R{resolution}' /
+                f'{self.tile}_{label}_B{band}_{resolution}.tif')
+
+    def composite(self, dates, label, method='median', force=False):
+        """
+        Builds one composite from the given dates
+        :param dates: capture dates of the period
+        :param label: name of the composite, used in place of a date later on
+        :param method: 'median', 'max_ndvi' or 'best_pixel'
+        :param force: rebuild an existing composite
+        :return: label
+        """
+        if method not in METHODS:
+            raise ValueError(f'Unknown method {method}, use one of {METHODS}')
+        outputs = {(band, resolution): self.output_path(label, band,
+                                                        resolution)
+                   for resolution, bands in COMPOSITE_BANDS.items()
+                   for band in bands}
+        if not force and all(path.exists() for path in outputs.values()):
+            print(f'Composite {label} exists, skipping')
+            return label
+
+        try:
+            references = {resolution: self._dataset(dates[0], bands[0],
+                                                    resolution)
+                          for resolution, bands in COMPOSITE_BANDS.items()}
+            width = references['10m'].width
+            height = references['10m'].height
+            blocks = list(self._blocks(width, height))
+
+            with ExitStack() as files:
+                destinations = {}
+                for (band, resolution), path in outputs.items():
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    block_size = (self.block_size if resolution == '10m'
+                                  else self.block_size // 2)
+                    profile = references[resolution].profile.copy()
+                    for key in ('blockxsize', 'blockysize', 'tiled',
+                                'compress', 'interleave', 'photometric'):
+                        profile.pop(key, None)
+                    profile.update({'driver': 'GTiff', 'count': 1,
+                                    'dtype': 'uint16', 'nodata': 0,
+                                    'tiled': True, 'blockxsize': block_size,
+                                    'blockysize': block_size,
+                                    'compress': 'deflate', 'predictor': 2})
+                    destinations[band, resolution] = files.enter_context(
+                        rasterio.open(path, 'w', **profile))
+
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    results = executor.map(
+                        lambda window: self._composite_block(dates, method,
+                                                             window), blocks)
+                    for counter, (window, result) in enumerate(
+                            zip(blocks, results), start=1):
+                        for (band, resolution), values in result.items():
+                            if resolution == '20m':
+                                target = Window(window.col_off // 2,
+                                                window.row_off // 2,
+                                                values.shape[1],
+                                                values.shape[0])
+                            else:
+                                target = window
+                            values = np.nan_to_num(np.rint(values), nan=0)
+                            destinations[band, resolution].write(
+                                values.astype(np.uint16), 1, window=target)
+                        if counter % 20 == 0 or counter == len(blocks):
+                            print(f'{label}: composited block '
+                                  f'{counter}/{len(blocks)}')
+        finally:
+            self._close()
+        print(f'Composite {label} built from {len(dates)} dates')
+        return label
+
+    def composite_periods(self, dates=None, period='month', method='median',
+                          min_dates=1, force=False):
+        """
+        Builds a composite for every period with at least min_dates scenes
+        :param dates: capture dates, default: all extracted scenes
+        :return: composite labels in time order, usable as Timeseries dates
+        """
+        if dates is None:
+            dates = self.available_dates()
+        labels = []
+        for label, period_dates in group_dates(dates, period).items():
+            if len(period_dates) < min_dates:
+                print(f'Skipping {label}, only {len(period_dates)} dates')
+                continue
+            labels.append(self.composite(period_dates, label, method, force))
+        return labels
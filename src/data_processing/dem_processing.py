@@ -4,7 +4,6 @@ import rasterio
 from rasterio.transform import Affine
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from rasterio.coords import BoundingBox
-from scipy.interpolate import NearestNDInterpolator
 
 
 
@@ -22,6 +21,8 @@ class DEMProcessor:
         self.target_crs = target_crs
 
     def _clean_raster(self, raster):
+        from scipy.interpolate import NearestNDInterpolator
+
         mask = raster.data != raster.meta['nodata']
 
         rows, cols = np.where(mask)
@@ -112,13 +113,18 @@ class DEMProcessor:
         print(f'Reprojecting {len(rasters_to_reproject)} rasters')
 
         counter = 0
-
+        reprojected = {}
         for raster in rasters_to_reproject:
             counter += 1
             print(
                 f'Raster {counter}/{len(rasters_to_reproject)} being reprojected...')
 
-            self._reproject_raster(raster, self.target_crs)
+            reprojected[id(raster)] = self._reproject_raster(raster,
+                                                             self.target_crs)
+
+        self.rasters = tuple(reprojected.get(id(raster), raster)
+                             for raster in self.rasters)
+        return self.rasters
 
     def merge_rasters(self, raster_index1: int, raster_index2: int):
         print(f'Merging rasters...')
@@ -0,0 +1,267 @@
+import json
+import re
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds
+
+from src.helper import *
+from .raster_calculator import RasterCalculator
+
+
+class FootprintIndex:
+    """
+    FootprintIndex: Spatial index over the footprints of per-date rasters
+
+    Footprints are kept in flat numpy arrays so that a bounding box query is a
+    single vectorized comparison instead of opening every file.
+    """
+
+    def __init__(self):
+        self.dates = []
+        self.paths = []
+        self._bounds = np.empty((0, 4), dtype=np.float64)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def add(self, date, path, bounds):
+        self.dates.append(date)
+        self.paths.append(path)
+        self._bounds = np.vstack([self._bounds,
+                                  np.asarray(bounds, dtype=np.float64)])
+
+    def query(self, bounds, dates=None):
+        """
+        Returns (date, path) pairs whose footprint intersects the bounds
+        :param bounds: (left, bottom, right, top) in map coordinates
+        :param dates: optional iterable of dates to restrict the result to
+        :return: list of (date, path) sorted by date
+        """
+        left, bottom, right, top = bounds
+        hits = ((self._bounds[:, 0] <= right) & (self._bounds[:, 2] >= left) &
+                (self._bounds[:, 1] <= top) & (self._bounds[:, 3] >= bottom))
+        selected = [(self.dates[i], self.paths[i]) for i in np.flatnonzero(hits)]
+        if dates is not None:
+            dates = set(dates)
+            selected = [entry for entry in selected if entry[0] in dates]
+        return sorted(selected)
+
+
+class PixelQuery:
+    """
+    PixelQuery: Returns index time series for a point or small polygon
+
+    Reads only the blocks touching the query from the cached per-date index
+    rasters (as written by RasterCalculator with save_file=True), so a query
+    costs a handful of small window reads instead of a full Timeseries.
+
+    Arguments:
+        - tile: Tile to query
+        - index: Index of the cached rasters, e.g. 'savi'
+        - raster_dir: Directory containing {tile}_{date}_{index}.tif files
+    """
+
+    def __init__(self, tile, index='savi', raster_dir='results/rasters'):
+        self.tile = tile
+        self.index = index
+        self.raster_dir = Path(raster_dir)
+        if not self.raster_dir.is_absolute():
+            self.raster_dir = Path(__file__).parents[2] / self.raster_dir
+        self.footprints = FootprintIndex()
+        self._datasets = {}
+        self.refresh()
+
+    def refresh(self):
+        """Rebuilds the footprint index from the files in raster_dir"""
+        self.close()
+        self.footprints = FootprintIndex()
+        pattern = re.compile(
+            rf'^{re.escape(self.tile)}_(\d{{8}})_{re.escape(self.index)}\.tif$')
+        for path in sorted(self.raster_dir.glob(f'{self.tile}_*_{self.index}.tif')):
+            match = pattern.match(path.name)
+            if match is None:
+                continue
+            with rasterio.open(path) as src:
+                self.footprints.add(match.group(1), path, tuple(src.bounds))
+        print(f'Indexed {len(self.footprints)} {self.index} rasters for '
+              f'{self.tile}')
+
+    def build_cache(self, dates, use_bounds=False, bounds=None):
+        """
+        Calculates and saves the per-date rasters that are not cached yet
+        :param dates: dates to make available for queries
+        :param use_bounds: only calculate the windowed area
+        :param bounds: borders passed to RasterCalculator.set_borders
+        """
+        missing = [date for date in dates if not
+                   (self.raster_dir / f'{self.tile}_{date}_{self.index}.tif').exists()]
+        if missing:
+            self.raster_dir.mkdir(parents=True, exist_ok=True)
+            calculator = RasterCalculator('data/processed',
+                                          results_folder=self.raster_dir)
+            if bounds is not None:
+                calculator.set_borders(bounds)
+            method = getattr(calculator, f'calculate_{self.index}')
+            for counter, date in enumerate(missing, start=1):
+                print(f'Caching {self.index} {counter}/{len(missing)}: {date}')
+                method(self.tile, date, save_file=True, use_bounds=use_bounds)
+        self.refresh()
+
+    def _dataset(self, path):
+        if path not in self._datasets:
+            self._datasets[path] = rasterio.open(path)
+        return self._datasets[path]
+
+    def query_point(self, x, y, dates=None):
+        """
+        Returns the index time series at a point
+        :param x: easting in the raster CRS
+        :param y: northing in the raster CRS
+        :param dates: optional subset of dates
+        :return: dict with 'dates' and 'values' (NaN where nodata)
+        """
+        result = {'dates': [], 'values': []}
+        for date, path in self.footprints.query((x, y, x, y), dates):
+            src = self._dataset(path)
+            row, col = src.index(x, y)
+            if not (0 <= row < src.height and 0 <= col < src.width):
+                continue
+            value = src.read(1, window=Window(col, row, 1, 1))[0, 0]
+            if src.nodata is not None and value == src.nodata:
+                value = np.nan
+            result['dates'].append(date)
+            result['values'].append(float(value))
+        return result
+
+    def query_polygon(self, coordinates, dates=None):
+        """
+        Returns per-date statistics of the pixels inside a polygon
+        :param coordinates: polygon exterior ring as [(x, y), ...]
+        :param dates: optional subset of dates
+        :return: dict with 'dates', 'mean', 'std' and 'count'
+        """
+        ring = np.asarray(coordinates, dtype=np.float64)
+        if ring.ndim != 2 or ring.shape[1] != 2 or len(ring) < 3:
+            raise ValueError('A polygon needs at least three (x, y) points')
+        if not np.array_equal(ring[0], ring[-1]):
+            # rasterio skips open rings as invalid shapes
+            ring = np.vstack([ring, ring[:1]])
+        if len(ring) < 4:
+            raise ValueError('A polygon needs at least three (x, y) points')
+        geometry = {'type': 'Polygon', 'coordinates': [ring.tolist()]}
+        bounds = (ring[:, 0].min(), ring[:, 1].min(),
+                  ring[:, 0].max(), ring[:, 1].max())
+
+        result = {'dates': [], 'mean': [], 'std': [], 'count': []}
+        for date, path in self.footprints.query(bounds, dates):
+            src = self._dataset(path)
+            window = from_bounds(*bounds, transform=src.transform)
+            # footprints match with inclusive bounds, so a polygon touching
+            # only the edge of a raster ends up with an empty window here
+            col_off = max(int(np.floor(window.col_off)), 0)
+            row_off = max(int(np.floor(window.row_off)), 0)
+            col_end = min(int(np.ceil(window.col_off + window.width)),
+                          src.width)
+            row_end = min(int(np.ceil(window.row_off + window.height)),
+                          src.height)
+            if col_end <= col_off or row_end <= row_off:
+                continue
+            window = Window(col_off, row_off, col_end - col_off,
+                            row_end - row_off)
+            data = src.read(1, window=window).astype(np.float64)
+            inside = geometry_mask([geometry], out_shape=data.shape,
+                                   transform=src.window_transform(window),
+                                   invert=True, all_touched=True)
+            if src.nodata is not None:
+                inside &= data != src.nodata
+            inside &= np.isfinite(data)
+            values = data[inside]
+
+            result['dates'].append(date)
+            result['count'].append(int(values.size))
+            if values.size:
+                result['mean'].append(float(values.mean()))
+                result['std'].append(float(values.std()))
+            else:
+                result['mean'].append(np.nan)
+                result['std'].append(np.nan)
+        return result
+
+    def close(self):
+        for src in self._datasets.values():
+            src.close()
+        self._datasets = {}
+
+
+def _json_safe(result):
+    return {key: [None if isinstance(v, float) and np.isnan(v) else v
+                  for v in values] for key, values in result.items()}
+
+
+def serve_pixel_queries(query: PixelQuery, host='127.0.0.1', port=8000):
+    """
+    Serves a PixelQuery over local HTTP
+
+    GET  /point?x=..&y=..[&dates=d1,d2]  -> point time series
+    POST /polygon  {"coordinates": [[x, y], ...], "dates": [...]}
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/point':
+                self._reply(404, {'error': f'unknown path {url.path}'})
+                return
+            params = parse_qs(url.query)
+            try:
+                x = float(params['x'][0])
+                y = float(params['y'][0])
+            except (KeyError, ValueError):
+                self._reply(400, {'error': 'x and y are required numbers'})
+                return
+            dates = params['dates'][0].split(',') if 'dates' in params else None
+            self._reply(200, _json_safe(query.query_point(x, y, dates)))
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/polygon':
+                self._reply(404, {'error': f'unknown path {self.path}'})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                request = json.loads(self.rfile.read(length))
+                coordinates = request['coordinates']
+            except (ValueError, KeyError, TypeError):
+                # TypeError: the body is JSON, but not an object
+                self._reply(400, {'error': 'body needs "coordinates"'})
+                return
+            try:
+                result = query.query_polygon(coordinates,
+                                             request.get('dates'))
+            except (ValueError, TypeError) as error:
+                self._reply(400, {'error': f'invalid polygon: {error}'})
+                return
+            self._reply(200, _json_safe(result))
+
+    server = HTTPServer((host, port), Handler)
+    print(f'Serving {query.index} queries for {query.tile} on '
+          f'http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        query.close()
@@ -19,10 +19,15 @@ class RasterCalculator:
 
     """
 
-    def __init__(self, band_dir, results_folder):
+    def __init__(self, band_dir, results_folder, save_options=None,
+                 inventory=None):
         """Initializes RasterCalculator with standard resolution of 10m and directory for data"""
         self.band_dir = band_dir
         self.results_folder = results_folder
+        # passed on to RasterData.save, e.g. {'compress': 'zstd', 'cog': True}
+        self.save_options = save_options or {}
+        # optional SceneInventory, looks up band paths instead of globbing
+        self.inventory = inventory
         self.borders = Window(0, 0, 0, 0)  # xmin, xmax, ymin, ymax
 
     def _selection(self, tile, capture_date, bands, resolution='10m',
@@ -34,10 +39,18 @@ class RasterCalculator:
         :param bands: which bands to return
         :return: path(s) to selected pictures
         """
+        if self.inventory is not None:
+            paths = self.inventory.band_paths(tile, capture_date, bands,
+                                              resolution)
+            if len(paths) == len(bands):
+                return [RasterData(path, read_with_window = use_window,
+                                   window = self.borders) for path in paths]
 
         resolution_selection = 'R' + resolution
         project_directory = Path(__file__).parents[2] / self.band_dir / tile / capture_date / resolution_selection
-        jp2_files = list(project_directory.glob('*.jp2'))
+        # composites are written as GeoTIFF next to the extracted scenes
+        jp2_files = (list(project_directory.glob('*.jp2')) +
+                     list(project_directory.glob('*.tif')))
         selected_rasters = []
         for band in bands:
 
@@ -49,10 +62,8 @@ class RasterCalculator:
 
 
     def set_borders(self, borders):
-        if borders == 'lapalma':
-            self.borders = Window(393, 340, 3698-393, 5148-340)
-        elif borders == 'lavaflow_lapalma':
-            self.borders = Window(1209, 2591, 2510-1209, 3860-2591)
+        if isinstance(borders, str):
+            self.borders = Window(*windows[borders])
         else:
             self.borders = Window(*borders)
 
@@ -76,7 +87,8 @@ class RasterCalculator:
                           RasterType.INDEX)
 
         if save_file:
-            ndvi.save(self.results_folder / f'{tile}_{capture_date}_ndvi.tif')
+            ndvi.save(self.results_folder / f'{tile}_{capture_date}_ndvi.tif',
+                      **self.save_options)
         return ndvi
 
     def calculate_savi(self, tile, capture_date, L=0.5, save_file=False, use_bounds=False):
@@ -102,7 +114,8 @@ class RasterCalculator:
 
 
         if save_file:
-            savi.save(Path(self.results_folder) / f'{tile}_{capture_date}_savi.tif')
+            savi.save(Path(self.results_folder) / f'{tile}_{capture_date}_savi.tif',
+                      **self.save_options)
         return savi
 
     def calculate_nbr(self, tile, capture_date, resolution='20m',
@@ -134,34 +147,48 @@ class RasterCalculator:
 
 
         if save_file:
-            nbr.save(Path(self.results_folder) / f'{tile}_{capture_date}_nbr.tif')
+            nbr.save(Path(self.results_folder) / f'{tile}_{capture_date}_nbr.tif',
+                     **self.save_options)
         return nbr
 
-    def temporal_comparison(self, tile, date1, date2, index='savi', save_file=False):
+    def temporal_comparison(self, tile, date1, date2, index='savi',
+                            save_file=False, use_bounds=False):
+        """
+        Difference pre - post of an index between two dates. For date sets,
+        composites or rasters too large for memory use ChangeDetector.
+        """
         if index not in ['savi', 'ndvi', 'nbr']:
             return None
 
         if index == 'savi':
-            pre = self.calculate_savi(tile, date1, save_file=False)
-            post = self.calculate_savi(tile, date2, save_file=False)
+            pre = self.calculate_savi(tile, date1, save_file=False,
+                                      use_bounds=use_bounds)
+            post = self.calculate_savi(tile, date2, save_file=False,
+                                       use_bounds=use_bounds)
         elif index == 'nbr':
-            pre = self.calculate_nbr(tile, date1, save_file=False)
-            post = self.calculate_nbr(tile, date2, save_file=False)
+            pre = self.calculate_nbr(tile, date1, save_file=False,
+                                     use_bounds=use_bounds)
+            post = self.calculate_nbr(tile, date2, save_file=False,
+                                      use_bounds=use_bounds)
         elif index == 'ndvi':
-            pre = self.calculate_ndvi(tile, date1, save_file=False)
-            post = self.calculate_ndvi(tile, date2, save_file=False)
+            pre = self.calculate_ndvi(tile, date1, save_file=False,
+                                      use_bounds=use_bounds)
+            post = self.calculate_ndvi(tile, date2, save_file=False,
+                                       use_bounds=use_bounds)
         else:
             print('Please select a valid index')
             return None
-        result = RasterData(data = pre - post, meta = pre.meta, state =
+        result = RasterData(data = pre.data - post.data, meta = pre.meta, state =
         RasterState.CALCULATED, rastertype= RasterType.INDEX)
         if save_file:
-            result.save(self.results_folder / f'{tile}_{date1}_{date2}_{index}.png')
+            result.save(Path(self.results_folder) / f'{tile}_{date1}_{date2}_d{index}.tif',
+                        **self.save_options)
         return result
 
     def calculate_ndwi(self, tile, capture_date, save_file = False,
                    use_bounds=False):
-        water_band_data = self._selection(tile, capture_date, ['03', '08'])
+        water_band_data = self._selection(tile, capture_date, ['03', '08'],
+                                          use_window=use_bounds)
 
         green = np.clip(water_band_data[0].data / 10000, 0, 1)
         nir = np.clip(water_band_data[1].data / 10000, 0, 1)
@@ -170,7 +197,8 @@ class RasterCalculator:
         ndwi = RasterData(data = ndwi_data, meta = water_band_data[0].meta,
                           state = RasterState.CALCULATED, rastertype= RasterType.INDEX)
         if save_file:
-            ndwi.save(Path(self.results_folder) / f'{tile}_{capture_date}_ndwi.tif')
+            ndwi.save(Path(self.results_folder) / f'{tile}_{capture_date}_ndwi.tif',
+                      **self.save_options)
 
         return ndwi
 
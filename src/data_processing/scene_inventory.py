@@ -0,0 +1,320 @@
+import sqlite3
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from src.helper import *
+from src.helper import lookup
+from .sentinel_processor import SentinelProcessor
+
+# SCL values of cloud shadows, medium/high probability clouds and cirrus
+SCL_CLOUD = (3, 8, 9, 10)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    tile TEXT NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT,
+    cloud_cover REAL,
+    sun_zenith REAL,
+    sun_azimuth REAL,
+    safe TEXT,
+    PRIMARY KEY (tile, date)
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    tile TEXT NOT NULL,
+    area TEXT NOT NULL,
+    date TEXT NOT NULL,
+    valid_fraction REAL,
+    cloud_fraction REAL,
+    PRIMARY KEY (tile, area, date)
+);
+CREATE TABLE IF NOT EXISTS bands (
+    tile TEXT NOT NULL,
+    date TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    band TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (tile, date, resolution, band)
+);
+'''
+
+
+def window_name(window):
+    """Name of a window in the inventory: its lookup name or the numbers"""
+    if window is None:
+        return 'full'
+    if isinstance(window, str):
+        return window
+    return '_'.join(str(int(part)) for part in window)
+
+
+def _find(root, tag):
+    """First element with tag, ignoring the namespaces of the SAFE files"""
+    for element in root.iter():
+        if element.tag.rsplit('}', 1)[-1] == tag:
+            return element
+    return None
+
+
+def _float(element):
+    return float(element.text) if element is not None else None
+
+
+def read_safe_metadata(safe_path):
+    """
+    Reads cloud cover and mean sun angles of an L2A SAFE folder
+    :param safe_path: path of the .SAFE folder
+    :return: dict with cloud_cover (percent), sun_zenith and sun_azimuth
+    """
+    safe_path = Path(safe_path)
+    metadata = {'cloud_cover': None, 'sun_zenith': None,
+                'sun_azimuth': None}
+    product = safe_path / 'MTD_MSIL2A.xml'
+    if product.exists():
+        root = ElementTree.parse(product).getroot()
+        metadata['cloud_cover'] = _float(_find(root,
+                                               'Cloud_Coverage_Assessment'))
+    for granule in (safe_path / 'GRANULE').glob('*/MTD_TL.xml'):
+        root = ElementTree.parse(granule).getroot()
+        angles = _find(root, 'Mean_Sun_Angle')
+        if angles is not None:
+            metadata['sun_zenith'] = _float(_find(angles, 'ZENITH_ANGLE'))
+            metadata['sun_azimuth'] = _float(_find(angles, 'AZIMUTH_ANGLE'))
+        break
+    return metadata
+
+
+class SceneInventory:
+    """
+    SceneInventory: Indexed table of the available Sentinel-2 scenes
+
+    Scans the processed tree (one folder per tile and date) and the SAFE
+    metadata in data/raw, and stores per scene the cloud cover and sun angle
+    of the product, the path of every band and, per window, the fraction of
+    clear (lookup.scl_valid) and cloudy pixels in the SCL band. Everything is
+    kept in a SQLite file, so date sets are a query instead of a hand-picked
+    list and band lookups need no directory globbing.
+
+    Arguments:
+        - database: SQLite file, relative to the project
+        - processed_path: Directory of the extracted bands
+        - raw_path: Directory of the SAFE folders, used for metadata
+    """
+
+    def __init__(self, database='data/inventory.sqlite',
+                 processed_path='data/processed', raw_path='data/raw'):
+        root = Path(__file__).parents[2]
+        self.database = root / database
+        self.processed_path = root / processed_path
+        self.raw_path = root / raw_path
+        self.database.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.database)
+        self.connection.executescript(SCHEMA)
+
+    def _safe_metadata(self):
+        """Metadata of all SAFE folders, by (tile, date)"""
+        metadata = {}
+        if not self.raw_path.exists():
+            return metadata
+        processor = SentinelProcessor(self.raw_path, self.processed_path)
+        for safe_file in processor.find_safe_files():
+            tile, date, time = processor.parse_safe_name(safe_file)
+            metadata[tile, date] = {'time': time, 'safe': safe_file,
+                                    **read_safe_metadata(
+                                        self.raw_path / safe_file)}
+        return metadata
+
+    def _bands(self, scene):
+        bands = []
+        for directory in sorted(scene.glob('R*m')):
+            resolution = directory.name[1:]
+            for path in directory.iterdir():
+                if path.suffix not in ('.jp2', '.tif'):
+                    continue
+                # e.g. T28RBS_20190213T120000_B04_10m.jp2
+                parts = path.stem.split('_')
+                if len(parts) < 3:
+                    continue
+                band = parts[-2]
+                bands.append((resolution, band[1:] if band.startswith('B')
+                              else band, str(path)))
+        return bands
+
+    @staticmethod
+    def _coverage(scl_path, windows):
+        """Clear and cloudy fraction of the SCL band for every window"""
+        coverage = {}
+        with rasterio.open(scl_path) as src:
+            scl = src.read(1)
+        clear = np.isin(scl, scl_valid)
+        cloudy = np.isin(scl, SCL_CLOUD)
+        for name, window in windows.items():
+            if window is None:
+                rows = cols = slice(None)
+            else:
+                # windows are given on the 10m grid, SCL is 20m
+                col_off, row_off, width, height = (int(part) // 2
+                                                   for part in window)
+                rows = slice(row_off, row_off + height)
+                cols = slice(col_off, col_off + width)
+            pixels = clear[rows, cols].size
+            coverage[name] = (
+                float(clear[rows, cols].sum() / pixels) if pixels else None,
+                float(cloudy[rows, cols].sum() / pixels) if pixels else None)
+        return coverage
+
+    def scan(self, windows=None, workers=4, force=False):
+        """
+        Adds scenes of the processed tree that are not in the inventory yet
+        :param windows: dict of name to window, default: lookup.windows; the
+            full tile is always included
+        :param workers: threads reading SCL bands
+        :param force: rescan scenes already in the inventory
+        :return: number of scanned scenes
+        """
+        windows = {'full': None, **(lookup.windows if windows is None
+                                    else windows)}
+        known = set(self.connection.execute('SELECT tile, date FROM scenes'))
+        scenes = [scene for tile in sorted(self.processed_path.glob('*'))
+                  if tile.is_dir()
+                  for scene in sorted(tile.glob('*'))
+                  if scene.is_dir() and len(scene.name) == 8
+                  and scene.name.isdigit()
+                  and (force or (tile.name, scene.name) not in known)]
+        if not scenes:
+            print('Inventory is up to date')
+            return 0
+        metadata = self._safe_metadata()
+
+        def scan_scene(scene):
+            bands = self._bands(scene)
+            scl = [path for resolution, band, path in bands
+                   if band == 'SCL' and resolution == '20m']
+            coverage = self._coverage(scl[0], windows) if scl else {}
+            return scene, bands, coverage
+
+        with ThreadPoolExecutor(max_workers=workers) as executor, \
+                self.connection:
+            for counter, (scene, bands, coverage) in enumerate(
+                    executor.map(scan_scene, scenes), start=1):
+                tile, date = scene.parent.name, scene.name
+                info = metadata.get((tile, date), {})
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (tile, date, info.get('time'), info.get('cloud_cover'),
+                     info.get('sun_zenith'), info.get('sun_azimuth'),
+                     info.get('safe')))
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO bands VALUES (?, ?, ?, ?, ?)',
+                    [(tile, date, *band) for band in bands])
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?)',
+                    [(tile, name, date, *fractions)
+                     for name, fractions in coverage.items()])
+                print(f'Scanned {tile} {date} ({counter}/{len(scenes)})')
+        return len(scenes)
+
+    def _ensure_window(self, tile, window):
+        """Computes the coverage of a window that was not scanned yet"""
+        name = window_name(window)
+        missing = self.connection.execute(
+            'SELECT s.date, b.path FROM scenes s JOIN bands b '
+            'ON b.tile = s.tile AND b.date = s.date '
+            "AND b.band = 'SCL' AND b.resolution = '20m' "
+            'LEFT JOIN coverage c ON c.tile = s.tile AND c.date = s.date '
+            'AND c.area = ? WHERE s.tile = ? AND c.date IS NULL',
+            (name, tile)).fetchall()
+        if not missing:
+            return name
+        if isinstance(window, str):
+            window = lookup.windows[window]
+        with self.connection:
+            for date, path in missing:
+                valid, cloudy = self._coverage(path, {name: window})[name]
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?)',
+                    (tile, name, date, valid, cloudy))
+        return name
+
+    def query(self, tile='T28RBS', year=None, start=None, end=None,
+              max_cloud=None, window=None, min_valid=None,
+              max_sun_zenith=None):
+        """
+        Selects dates, e.g. all 2019 scenes with < 10 % cloud over lapalma:
+        query('T28RBS', year=2019, max_cloud=10, window='lapalma')
+        :param start: first date (YYYYMMDD), inclusive
+        :param end: last date (YYYYMMDD), inclusive
+        :param max_cloud: maximum cloud cover in percent; over the window if
+            one is given, otherwise from the product metadata (or the SCL of
+            the full tile when there is no metadata)
+        :param window: name from lookup.windows or (col_off, row_off, width,
+            height) on the 10m grid
+        :param min_valid: minimum fraction of clear pixels in the window
+        :return: sorted list of dates, ready for Timeseries
+        """
+        name = self._ensure_window(tile, window)
+        sql = ('SELECT s.date FROM scenes s LEFT JOIN coverage c '
+               'ON c.tile = s.tile AND c.date = s.date AND c.area = ? '
+               'WHERE s.tile = ?')
+        parameters = [name, tile]
+        if year is not None:
+            sql += ' AND s.date LIKE ?'
+            parameters.append(f'{year}%')
+        if start is not None:
+            sql += ' AND s.date >= ?'
+            parameters.append(str(start))
+        if end is not None:
+            sql += ' AND s.date <= ?'
+            parameters.append(str(end))
+        if max_cloud is not None:
+            if window is None:
+                sql += (' AND COALESCE(s.cloud_cover, 100 * c.cloud_fraction)'
+                        ' <= ?')
+            else:
+                sql += ' AND 100 * c.cloud_fraction <= ?'
+            parameters.append(max_cloud)
+        if min_valid is not None:
+            sql += ' AND c.valid_fraction >= ?'
+            parameters.append(min_valid)
+        if max_sun_zenith is not None:
+            sql += ' AND s.sun_zenith <= ?'
+            parameters.append(max_sun_zenith)
+        sql += ' ORDER BY s.date'
+        return [date for (date,) in self.connection.execute(sql, parameters)]
+
+    def band_paths(self, tile, date, bands, resolution='10m'):
+        """Paths of the given bands of a scene, in the order of bands"""
+        rows = dict(self.connection.execute(
+            'SELECT band, path FROM bands WHERE tile = ? AND date = ? '
+            'AND resolution = ?', (tile, date, resolution)))
+        return [Path(rows[band]) for band in bands if band in rows]
+
+    def summary(self, tile='T28RBS', window=None):
+        """Prints one line per scene"""
+        name = self._ensure_window(tile, window)
+        rows = self.connection.execute(
+            'SELECT s.date, s.cloud_cover, s.sun_zenith, c.valid_fraction, '
+            'c.cloud_fraction FROM scenes s LEFT JOIN coverage c '
+            'ON c.tile = s.tile AND c.date = s.date AND c.area = ? '
+            'WHERE s.tile = ? ORDER BY s.date', (name, tile))
+        print(f'{tile}, window {name}')
+        print('date      product cloud  sun zenith  clear  cloudy')
+        for date, cloud_cover, sun_zenith, valid, cloudy in rows:
+            print(f'{date}  {_percent(cloud_cover, 1):>13}  '
+                  f'{_number(sun_zenith):>10}  {_percent(valid):>5}  '
+                  f'{_percent(cloudy):>6}')
+
+    def close(self):
+        self.connection.close()
+
+
+def _percent(value, scale=100):
+    return '-' if value is None else f'{value * scale:.0f}%'
+
+
+def _number(value):
+    return '-' if value is None else f'{value:.1f}'
@@ -50,6 +50,18 @@ class SentinelProcessor:
 
         shutil.copytree(img_path, target, dirs_exist_ok=True)
 
+    def find_safe_files(self):
+        """Names of the .SAFE folders in raw_path"""
+        return self._find_safe_files()
+
+    def parse_safe_name(self, safe_name):
+        """Tile, date (YYYYMMDD) and time of a .SAFE folder name"""
+        return self._parse_safe_name(safe_name)
+
+    def extract(self, safe_file):
+        """Copies the bands of one .SAFE folder to processed_path/tile/date"""
+        self._extract_bands(safe_file)
+
     def process_all(self):
         safe_files = self._find_safe_files()
         for safe_file in safe_files:
@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from src.helper import *
+from src.helper.shared_array import row_chunks
+
+
+def focal_mean(data, size=3):
+    """Mean of the valid pixels in a size x size neighbourhood"""
+    valid = np.isfinite(data)
+    values = np.where(valid, data, 0).astype(np.float64)
+    total = ndimage.uniform_filter(values, size, mode='constant')
+    count = ndimage.uniform_filter(valid.astype(np.float64), size,
+                                   mode='constant')
+    mean = np.divide(total, count, out=np.full(data.shape, np.nan),
+                     where=count > 0)
+    mean[~valid] = np.nan
+    return mean
+
+
+def focal_std(data, size=3):
+    """Standard deviation of the valid pixels in a size x size neighbourhood"""
+    valid = np.isfinite(data)
+    values = np.where(valid, data, 0).astype(np.float64)
+    count = ndimage.uniform_filter(valid.astype(np.float64), size,
+                                   mode='constant')
+    has_values = count > 0
+    mean = np.divide(ndimage.uniform_filter(values, size, mode='constant'),
+                     count, out=np.zeros(data.shape), where=has_values)
+    squares = np.divide(ndimage.uniform_filter(values ** 2, size,
+                                               mode='constant'),
+                        count, out=np.zeros(data.shape), where=has_values)
+    std = np.sqrt(np.maximum(squares - mean ** 2, 0))
+    std[~valid] = np.nan
+    return std
+
+
+def majority(labels, size=3, classes=None):
+    """
+    Most frequent label in a size x size neighbourhood. Ties keep the
+    pixel's own label; NaN pixels are neither counted nor changed.
+    """
+    if classes is None:
+        classes = np.unique(labels[np.isfinite(labels)])
+    result = labels.copy()
+    best = np.full(labels.shape, -1, dtype=np.float32)
+    for label in classes:
+        member = labels == label
+        # one uniform filter per class instead of a Python call per pixel;
+        # 0/1 inputs keep the neighbourhood counts exact
+        count = ndimage.uniform_filter(member.astype(np.float32), size,
+                                       mode='constant')
+        count += member * np.float32(0.5 / size ** 2)
+        better = count > best
+        result[better] = label
+        best[better] = count[better]
+    result[~np.isfinite(labels)] = np.nan
+    return result
+
+
+KERNELS = {'mean': focal_mean, 'std': focal_std, 'majority': majority}
+
+
+def _filter_rows(start, stop, source, target, kernel, size, options):
+    """Filters rows start:stop of source with a halo of size // 2 rows"""
+    halo = size // 2
+    low = max(start - halo, 0)
+    high = min(stop + halo, source.shape[0])
+    filtered = KERNELS[kernel](source[low:high], size, **options)
+    target[start:stop] = filtered[start - low:stop - low]
+
+
+def _filter_shared_rows(start, stop, source_handle, target_handle, kernel,
+                        size, options):
+    source = source_handle.attach()
+    target = target_handle.attach()
+    _filter_rows(start, stop, source.array, target.array, kernel, size,
+                 options)
+    source.close()
+    target.close()
+
+
+class SpatialFilter:
+    """
+    SpatialFilter: Neighbourhood post-processing of Timeseries results
+
+    Majority filter for cluster labels, focal mean/std for slope or index
+    rasters and connected recovery patches. Filters are built from
+    scipy.ndimage.uniform_filter and run on row chunks with a halo of
+    size // 2 rows, so the result equals filtering the whole raster at
+    once; with workers > 1 the chunks are spread over processes working on
+    shared memory.
+
+    Arguments:
+        - chunk_rows: Rows per chunk, default: split evenly over the workers
+        - workers: Worker processes, 1 filters in this process
+    """
+
+    def __init__(self, chunk_rows=None, workers=1):
+        self.chunk_rows = chunk_rows
+        self.workers = workers or os.cpu_count() or 1
+
+    def _apply(self, raster, kernel, size, **options):
+        if size % 2 == 0:
+            raise ValueError('size has to be odd')
+        data = raster.data if isinstance(raster, RasterData) else raster
+        data = np.asarray(data, dtype=np.float64)
+        rows = data.shape[0]
+        if self.workers == 1:
+            result = np.empty_like(data)
+            for start, stop in row_chunks(rows, 1, self.chunk_rows):
+                _filter_rows(start, stop, data, result, kernel, size, options)
+        else:
+            with SharedArray.from_array(data) as source, \
+                    SharedArray(data.shape, data.dtype) as target:
+                run_chunked(_filter_shared_rows, rows, source.handle,
+                            target.handle, kernel, size, options,
+                            workers=self.workers, chunk_rows=self.chunk_rows)
+                result = target.array.copy()
+
+        if not isinstance(raster, RasterData):
+            return result
+        return RasterData(data = result, meta = raster.meta.copy(),
+                          state = RasterState.CALCULATED,
+                          rastertype = raster.rastertype)
+
+    def majority_filter(self, raster, size=3):
+        """
+        Replaces every label by the most frequent one around it
+        :param raster: label RasterData or array, e.g. create_clusters_matrix
+        :param size: odd edge length of the neighbourhood
+        :return: smoothed labels, same type as raster
+        """
+        data = raster.data if isinstance(raster, RasterData) else raster
+        classes = np.unique(data[np.isfinite(data)])
+        return self._apply(raster, 'majority', size, classes=classes)
+
+    def focal_mean(self, raster, size=3):
+        """NaN-aware neighbourhood mean, e.g. of calculate_slopes output"""
+        return self._apply(raster, 'mean', size)
+
+    def focal_std(self, raster, size=3):
+        """NaN-aware neighbourhood standard deviation"""
+        return self._apply(raster, 'std', size)
+
+    def connected_components(self, mask, min_pixels=1, diagonal=True):
+        """
+        Labels connected patches of a boolean mask
+        :param mask: boolean array or RasterData
+        :param min_pixels: patches with fewer pixels are dropped
+        :param diagonal: count diagonal neighbours as connected
+        :return: (labels 1..n with 0 as background, pixels per label)
+        """
+        data = mask.data if isinstance(mask, RasterData) else mask
+        data = np.asarray(data)
+        if data.dtype != bool:
+            data = np.isfinite(data) & (data != 0)
+        # labelling is a single compiled pass and has to see the whole
+        # raster to keep the labels consistent, so it is not chunked
+        structure = np.ones((3, 3)) if diagonal else None
+        labels, count = ndimage.label(data, structure=structure)
+        sizes = np.bincount(labels.ravel(), minlength=count + 1)
+        sizes[0] = 0
+        keep = sizes >= min_pixels
+        keep[0] = False
+        relabel = np.zeros(count + 1, dtype=labels.dtype)
+        relabel[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+        labels = relabel[labels]
+        sizes = np.concatenate([[0], sizes[keep]])
+
+        if isinstance(mask, RasterData):
+            labels = RasterData(data = labels, meta = mask.meta.copy(),
+                                state = RasterState.CALCULATED,
+                                rastertype = RasterType.INDEX)
+        print(f'{len(sizes) - 1} patches with at least {min_pixels} pixels')
+        return labels, sizes
+
+    def recovery_patches(self, slopes, threshold=0.0, size=3, min_pixels=25):
+        """
+        Patches of pixels whose smoothed trend is above threshold
+        :param slopes: calculate_slopes output
+        :param size: focal mean window applied first, 1 to skip
+        :return: see connected_components; the labels can be used as zones
+            for ZonalStatistics (ignore=0)
+        """
+        if size > 1:
+            slopes = self.focal_mean(slopes, size)
+        data = slopes.data if isinstance(slopes, RasterData) else slopes
+        mask = np.isfinite(data) & (data > threshold)
+        if isinstance(slopes, RasterData):
+            mask = RasterData(data = mask, meta = slopes.meta.copy(),
+                              state = RasterState.CALCULATED,
+                              rastertype = RasterType.INDEX)
+        return self.connected_components(mask, min_pixels)
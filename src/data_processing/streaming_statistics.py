@@ -0,0 +1,155 @@
+import numpy as np
+
+
+def histogram_percentile(histogram, count, q, value_range,
+                         chunk_size=2 ** 20):
+    """
+    Interpolates a percentile from fixed-bin histograms
+    :param histogram: counts with the bins on the last axis
+    :param count: number of values per histogram
+    :param q: percentile in 0..100
+    :param value_range: range covered by the bins
+    :param chunk_size: histogram entries processed at once; the cumulative
+        sums are int64, so larger histograms are split along the first axis
+    :return: percentile per histogram, NaN where count is 0
+    """
+    count = np.asarray(count)
+    if histogram.ndim > 1 and histogram.size > chunk_size:
+        rows = max(chunk_size // histogram[0].size, 1)
+        result = np.empty(count.shape)
+        for start in range(0, histogram.shape[0], rows):
+            result[start:start + rows] = histogram_percentile(
+                histogram[start:start + rows], count[start:start + rows], q,
+                value_range, chunk_size)
+        return result
+
+    low, high = value_range
+    bins = histogram.shape[-1]
+    width = (high - low) / bins
+    cumulative = np.cumsum(histogram, axis=-1, dtype=np.int64)
+    target = count * (q / 100)
+    bin_index = (cumulative < target[..., None]).sum(axis=-1)
+    bin_index = np.minimum(bin_index, bins - 1)
+
+    below = np.take_along_axis(cumulative, bin_index[..., None],
+                               axis=-1)[..., 0]
+    in_bin = np.take_along_axis(histogram, bin_index[..., None],
+                                axis=-1)[..., 0].astype(np.float64)
+    below = below - in_bin
+    fraction = np.divide(target - below, in_bin,
+                         out=np.zeros_like(target), where=in_bin > 0)
+    value = low + (bin_index + np.clip(fraction, 0, 1)) * width
+    return np.where(count > 0, value, np.nan)
+
+
+class StreamingStatistics:
+    """
+    StreamingStatistics: Per-pixel statistics updated one raster at a time
+
+    All accumulators are float64 arrays of the raster shape, so memory does
+    not depend on how many rasters are fed in. NaN values (and the optional
+    nodata value) are skipped per pixel.
+
+    Percentiles are estimated from a fixed-bin histogram per pixel over
+    value_range; values outside the range are counted in the edge bins. The
+    sketch costs bins * 2 bytes per pixel and is only allocated when
+    'percentiles' is requested.
+
+    Arguments:
+        - shape: Shape of the rasters that will be fed in
+        - statistics: Any of count, mean, std, var, min, max, percentiles
+        - percentiles: Percentiles to estimate, in 0..100
+        - value_range: Range covered by the histogram sketch
+        - bins: Number of histogram bins of the sketch
+        - nodata: Value treated as missing in addition to NaN
+    """
+
+    AVAILABLE = ('count', 'mean', 'std', 'var', 'min', 'max', 'percentiles')
+
+    def __init__(self, shape, statistics=('mean', 'std'),
+                 percentiles=(10, 50, 90), value_range=(-1, 1), bins=32,
+                 nodata=None):
+        unknown = set(statistics) - set(self.AVAILABLE)
+        if unknown:
+            raise ValueError(f'Unknown statistics {sorted(unknown)}, choose '
+                             f'from {self.AVAILABLE}')
+        self.shape = tuple(shape)
+        self.statistics = tuple(statistics)
+        self.percentiles = tuple(percentiles)
+        self.value_range = value_range
+        self.bins = bins
+        self.nodata = nodata
+
+        needs_moments = {'mean', 'std', 'var'} & set(self.statistics)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self._mean = np.zeros(self.shape) if needs_moments else None
+        self._m2 = (np.zeros(self.shape)
+                    if {'std', 'var'} & set(self.statistics) else None)
+        self._min = (np.full(self.shape, np.nan)
+                     if 'min' in self.statistics else None)
+        self._max = (np.full(self.shape, np.nan)
+                     if 'max' in self.statistics else None)
+        self._histogram = (np.zeros((*self.shape, bins), dtype=np.uint16)
+                           if 'percentiles' in self.statistics else None)
+
+    def update(self, data):
+        """Adds one raster to the accumulators"""
+        data = np.asarray(data, dtype=np.float64)
+        if data.shape != self.shape:
+            raise ValueError(f'Expected shape {self.shape} but got '
+                             f'{data.shape}')
+        valid = np.isfinite(data)
+        if self.nodata is not None:
+            valid &= data != self.nodata
+        self.count += valid
+
+        if self._mean is not None:
+            # Welford update, masked pixels get a zero delta
+            delta = np.where(valid, data - self._mean, 0.0)
+            self._mean += delta / np.maximum(self.count, 1)
+            if self._m2 is not None:
+                self._m2 += np.where(valid, delta * (data - self._mean), 0.0)
+
+        if self._min is not None:
+            np.fmin(self._min, np.where(valid, data, np.nan), out=self._min)
+        if self._max is not None:
+            np.fmax(self._max, np.where(valid, data, np.nan), out=self._max)
+
+        if self._histogram is not None:
+            low, high = self.value_range
+            bin_index = ((data[valid] - low) / (high - low) *
+                         self.bins).astype(np.int64)
+            np.clip(bin_index, 0, self.bins - 1, out=bin_index)
+            # every pixel appears at most once per update, so plain fancy
+            # index increments are safe
+            self._histogram[valid, bin_index] += 1
+
+    def _percentile(self, q):
+        return histogram_percentile(self._histogram, self.count, q,
+                                    self.value_range)
+
+    def result(self):
+        """
+        Returns the requested statistics
+        :return: dict of arrays, percentiles are stored as 'p<q>'
+        """
+        missing = self.count == 0
+        results = {}
+        for statistic in self.statistics:
+            if statistic == 'count':
+                results['count'] = self.count.copy()
+            elif statistic == 'mean':
+                results['mean'] = np.where(missing, np.nan, self._mean)
+            elif statistic in ('std', 'var'):
+                var = np.divide(self._m2, self.count,
+                                out=np.full(self.shape, np.nan),
+                                where=~missing)
+                results[statistic] = np.sqrt(var) if statistic == 'std' else var
+            elif statistic == 'min':
+                results['min'] = self._min.copy()
+            elif statistic == 'max':
+                results['max'] = self._max.copy()
+            elif statistic == 'percentiles':
+                for q in self.percentiles:
+                    results[f'p{q:g}'] = self._percentile(q)
+        return results
@@ -1,144 +1,451 @@
+from pathlib import Path
+
 import rasterio
 import numpy as np
 from numpy.polynomial.polynomial import polyfit
 
 from src.helper import *
-from src.data_processing import *
+from .raster_calculator import RasterCalculator
+from .scene_inventory import window_name
+from .streaming_statistics import StreamingStatistics
+from .zonal_statistics import ZonalStatistics
 from dataclasses import dataclass
 from numpy.polynomial import Polynomial as Poly
-from sklearn.cluster import KMeans
+
+
+def _clean_rows(data_matrix, threshold):
+    """Replaces drops below threshold in place, returns the number fixed"""
+    differences = data_matrix[:, 1:] - data_matrix[:, :-1]
+    pixel, timestep = np.where(differences < threshold)
+
+    for pixel_index, step in zip(pixel, timestep):
+        before_value = data_matrix[pixel_index, step]
+        if step +2 >= data_matrix.shape[1]:
+            after_value = before_value
+        else:
+            after_value = data_matrix[pixel_index, step + 2]
+        data_matrix[pixel_index, step+1] = (before_value + after_value)/2
+    return len(pixel)
+
+
+def _clean_shared_rows(start, stop, handle, threshold):
+    shared = handle.attach()
+    count = _clean_rows(shared.array[start:stop], threshold)
+    shared.close()
+    return count
+
+
+def _assign_shared_rows(start, stop, matrix_handle, n_dates, labels_handle,
+                        model):
+    matrix = matrix_handle.attach()
+    labels = labels_handle.attach()
+    labels.array[start:stop] = model.predict(
+        matrix.array[start:stop, :n_dates])
+    matrix.close()
+    labels.close()
+
+
+def analysis_path(dates, suffix, bounds = None, extension = '.tif'):
+    """
+    Path of an analysis result relative to the results folder; results of
+    different windows go to different folders
+    :param suffix: index and product, e.g. 'savi_clusters'
+    """
+    return (Path('analysis_results') / window_name(bounds) /
+            f'{dates[0]}_{dates[-1]}_{suffix}{extension}')
+
+
 class Timeseries:
-    def __init__(self,tile, dates, bounds = None) -> None:
+    def __init__(self,tile, dates, bounds = None, save_options = None,
+                 cache_dir = None, inventory = None) -> None:
         self.tile = tile
-        self.dates = dates
+        self.dates = list(dates)
         self.bounds = bounds
         self.raw_data = None
-        self.index_data = None
         self.matrix = None
+        self.index = None
+        self._buffer = None
+        self._last_raw = None
+        self._last_spike = None
+        self._running = None
+        self._shared = None
+        self.save_options = save_options or {}
+        # per-date index rasters are read from / written to this directory
+        self.cache_dir = Path(cache_dir).resolve() if cache_dir else None
+        self._sum_y = None
+        self._sum_xy = None
         self.calculator = RasterCalculator('data/processed',
-                                  results_folder='/rasters')
+                                  results_folder='/rasters',
+                                  inventory=inventory)
         if bounds is not None:
             self.calculator.set_borders(bounds)
         print(f'Timeseries initialized with {len(self.dates)} dates')
         print(f'Ready to create indices')
-        self.meta = self.calculator.calculate_savi(self.tile, self.dates[0],
-                                                          save_file = False,
-                                                          use_bounds=True).meta
+        self.meta = self._calculate_index('savi', self.dates[0]).meta
 
 
+    @classmethod
+    def from_inventory(cls, inventory, tile, bounds = None, year = None,
+                       max_cloud = None, min_valid = None, **kwargs):
+        """
+        Timeseries over the scenes of a SceneInventory query, e.g. all 2019
+        scenes with less than 10 % cloud over the bounds
+        :param inventory: SceneInventory
+        :param bounds: window of the analysis, also used for the cloud filter
+        :param kwargs: further SceneInventory.query filters (start, end,
+            max_sun_zenith) or Timeseries arguments
+        """
+        query = {key: kwargs.pop(key) for key in ('start', 'end',
+                                                  'max_sun_zenith')
+                 if key in kwargs}
+        dates = inventory.query(tile, year=year, max_cloud=max_cloud,
+                                window=bounds, min_valid=min_valid, **query)
+        if not dates:
+            raise ValueError('No scenes in the inventory match the query')
+        return cls(tile, dates, bounds=bounds, inventory=inventory, **kwargs)
+
+    def _output_path(self, suffix, extension = '.tif'):
+        path = analysis_path(self.dates, suffix, self.bounds, extension)
+        (Path('results') / path).parent.mkdir(parents=True, exist_ok=True)
+        return path
+
     def calculate(self, index, save_file = False):
-        self.index_data = None
-        temporary_list = []
-        for date in self.dates:
-            if self.bounds is not None:
-                if index == 'savi':
-                    data = self.calculator.calculate_savi(self.tile, date,
-                                                          save_file = False,
-                                                          use_bounds=True)
-                    temporary_list.append(data.data)
-                elif index == 'ndwi':
-                    data = self.calculator.calculate_ndwi(self.tile, date,
-                                                          save_file = False,
-                                                          use_bounds=True)
-                    temporary_list.append(data.data)
-                elif index == 'ndvi':
-                    data = self.calculator.calculate_ndvi(self.tile, date,
-                                                          save_file = False,
-                                                          use_bounds=True)
-
-                    temporary_list.append(data.data)
-                else:
-                    print(f'{index} not implemented yet')
-                    return
+        """
+        Calculates per-pixel mean and (scaled) std over all dates, streaming
+        one date at a time
+        :param index: Index to calculate
+        :return: pixel_mean, pixel_std as RasterData
+        """
+        statistics = self.calculate_statistics(index, ('mean', 'std'))
+        if statistics is None:
+            return
+        pixel_mean = statistics['mean']
+        pixel_std = statistics['std']
+        pixel_std.data = 10 * np.sqrt(pixel_std.data)
 
-        if temporary_list:
-            self.index_data = np.stack(temporary_list, axis = 0)
-        mean = np.mean(self.index_data, axis = 0)
-        std = 10* np.sqrt(np.std(self.index_data, axis = 0))
-        meta = data.meta.copy()
+        if save_file:
+            pixel_mean.save(self._output_path(f'{index}_mean'),
+                            **self.save_options)
+            pixel_std.save(self._output_path(f'{index}_std'),
+                           **self.save_options)
+        return pixel_mean, pixel_std
 
-        pixel_mean = RasterData(data = mean, meta = meta,
-                                state= RasterState.CALCULATED,
-                                rastertype= RasterType.INDEX)
+    def calculate_statistics(self, index, statistics = ('mean', 'std'),
+                             percentiles = (10, 50, 90), save_file = False):
+        """
+        Calculates per-pixel statistics over all dates without stacking them
+        :param index: Index to calculate
+        :param statistics: see StreamingStatistics.AVAILABLE
+        :param percentiles: percentiles to estimate if requested
+        :return: dict of RasterData, percentiles stored as 'p<q>'
+        """
+        reducer = None
+        meta = None
+        for counter, date in enumerate(self.dates, start=1):
+            if self.bounds is None:
+                continue
+            data = self._calculate_index(index, date)
+            if data is None:
+                return
+            if reducer is None:
+                reducer = StreamingStatistics(data.data.shape, statistics,
+                                              percentiles=percentiles)
+                meta = data.meta.copy()
+            reducer.update(data.data)
+            print(f'Added {counter}/{len(self.dates)} dates to statistics')
 
-        pixel_std = RasterData(data = std, meta = meta,
-                               state= RasterState.CALCULATED,
-                               rastertype= RasterType.INDEX)
+        if reducer is None:
+            return
+
+        results = {}
+        for name, values in reducer.result().items():
+            results[name] = RasterData(data = values, meta = meta.copy(),
+                                       state= RasterState.CALCULATED,
+                                       rastertype= RasterType.INDEX)
+            if save_file:
+                results[name].save(self._output_path(f'{index}_{name}'),
+                                   **self.save_options)
+        return results
 
+    def zonal_statistics(self, zones, index = 'savi',
+                         statistics = ('count', 'mean', 'std'),
+                         percentiles = (10, 50, 90), save_file = False,
+                         **kwargs):
+        """
+        Calculates statistics per zone and date, streaming one date at a time
+        :param zones: ZonalStatistics, label array/RasterData on the window
+            (e.g. create_clusters_matrix output) or a GeoJSON path
+        :param index: Index to calculate
+        :return: ZonalStatistics holding a (dates, zones) array per statistic
+        """
+        if not isinstance(zones, ZonalStatistics):
+            if isinstance(zones, (str, Path)):
+                zones = ZonalStatistics.from_geojson(
+                    zones, self.meta, statistics=statistics,
+                    percentiles=percentiles, **kwargs)
+            else:
+                zones = ZonalStatistics(zones, statistics=statistics,
+                                        percentiles=percentiles, **kwargs)
+        for counter, date in enumerate(self.dates, start=1):
+            data = self._calculate_index(index, date)
+            if data is None:
+                return
+            zones.update(data, date)
+            print(f'Added {counter}/{len(self.dates)} dates to zonal '
+                  f'statistics')
         if save_file:
-            pixel_mean.save(f'analysis_results/{self.dates[0]}_'
-                            f'{self.dates[-1]}_{index}_mean.tif')
-            pixel_std.save(f'analysis_results/{self.dates[0]}_'
-                           f'{self.dates[-1]}_{index}_std.tif')
-        return pixel_mean, pixel_std
+            # same folder RasterData.save writes the rasters to
+            zones.save_csv(Path('results') /
+                           self._output_path(f'{index}_zones', '.csv'))
+        return zones
+
+    def _calculate_index(self, index, date):
+        cached = None
+        if self.cache_dir is not None:
+            cached = self.cache_dir / f'{self.tile}_{date}_{index}.tif'
+            if cached.exists():
+                return RasterData(source = cached, state = RasterState.CALCULATED,
+                                  rastertype = RasterType.INDEX)
+        data = self._compute_index(index, date)
+        if data is not None and cached is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            data.save(cached, results_folder=None, **self.save_options)
+        return data
 
-    def create_timeseries_matrix(self, index):
+    def _compute_index(self, index, date):
+        if index == 'savi':
+            return self.calculator.calculate_savi(self.tile, date,
+                                                  save_file = False,
+                                                  use_bounds=True)
+        elif index == 'ndwi':
+            return self.calculator.calculate_ndwi(self.tile, date,
+                                                  save_file = False,
+                                                  use_bounds=True)
+        elif index == 'ndvi':
+            return self.calculator.calculate_ndvi(self.tile, date,
+                                                  save_file = False,
+                                                  use_bounds=True)
+        print(f'{index} not implemented yet')
+        return None
+
+    def create_timeseries_matrix(self, index, workers = 1):
         temporary_list = []
         data_matrix = None
         for date in self.dates:
             if self.bounds is not None:
-                if index == 'savi':
-                    data = self.calculator.calculate_savi(self.tile, date,
-                                                          save_file = False,
-                                                          use_bounds=True)
-                    temporary_list.append(data.data.flatten())
-                elif index == 'ndwi':
-                    data = self.calculator.calculate_ndwi(self.tile, date,
-                                                          save_file = False,
-                                                          use_bounds=True)
-                    temporary_list.append(data.data.flatten())
-                elif index == 'ndvi':
-                    data = self.calculator.calculate_ndvi(self.tile, date,
-                                                          save_file = False,
-                                                          use_bounds=True)
-
-                    temporary_list.append(data.data.flatten())
-                else:
-                    print(f'{index} not implemented yet')
+                data = self._calculate_index(index, date)
+                if data is None:
                     return
+                temporary_list.append(data.data.flatten())
 
         if temporary_list:
-            data_matrix = np.stack(temporary_list, axis = 0).T
-            data_matrix = self._clean_data_matrix(data_matrix, -0.2)
-            self.matrix = data_matrix
+            raw_matrix = np.stack(temporary_list, axis = 0).T
+            data_matrix = self._clean_data_matrix(raw_matrix, -0.2, workers)
+            self.index = index
+            self._init_accumulators(raw_matrix, data_matrix, -0.2)
         return data_matrix
 
-    def _clean_data_matrix(self, data_matrix, threshold):
-        data_matrix = data_matrix.copy()
-        differences = data_matrix[:, 1:] - data_matrix[:, :-1]
-        pixel, timestep = np.where(differences < threshold)
+    def _init_accumulators(self, raw_matrix, data_matrix, threshold):
+        """Sets up the running statistics from a freshly built matrix"""
+        pixels, n_dates = data_matrix.shape
+        # the matrix keeps its exact size, spare columns are only added
+        # once dates are appended
+        self._buffer = data_matrix
+        self.matrix = data_matrix
 
-        print(f'Difference matrix length: {len(differences)}')
-        print(f'{len(pixel)} pixels above threshold')
-        print(f'Portion of pixels above threshold: '
-              f'{len(pixel)/data_matrix.size}')
+        self._last_raw = raw_matrix[:, -1].astype(np.float64)
+        if n_dates > 1:
+            self._last_spike = (raw_matrix[:, -1] - raw_matrix[:, -2]) < threshold
+        else:
+            self._last_spike = np.zeros(pixels, dtype=bool)
 
-        for pixel, timestep in zip(pixel, timestep):
-            before_value = data_matrix[pixel, timestep]
-            if timestep +2 >= data_matrix.shape[1]:
-                after_value = before_value
-            else:
-                after_value = data_matrix[pixel, timestep + 2]
-            data_matrix[pixel, timestep+1] = (before_value + after_value)/2
+        # Welford accumulators over the raw index values, as in calculate()
+        self._running = StreamingStatistics((pixels,), ('mean', 'std'))
+        for column in raw_matrix.T:
+            self._running.update(column)
+
+        # sufficient statistics of the regression y = a + b * t on the
+        # cleaned matrix, t = 0..n-1
+        x_axis = np.arange(n_dates, dtype=np.float64)
+        self._sum_y = data_matrix.sum(axis=1, dtype=np.float64)
+        self._sum_xy = data_matrix @ x_axis
+
+    def append(self, date, threshold = -0.2):
+        """
+        Adds a single acquisition without recomputing the existing dates
+        :param date: Capture date of the new acquisition
+        :param threshold: Spike threshold, same as create_timeseries_matrix
+        :return: the updated (cleaned) data matrix
+        """
+        if self.matrix is None:
+            raise ValueError('No matrix yet, call create_timeseries_matrix '
+                             'before appending dates')
+
+        data = self._calculate_index(self.index, date)
+        if data is None:
+            return
+        raw = data.data.flatten().astype(np.float64)
+        pixels, n_dates = self.matrix.shape
+        if raw.size != pixels:
+            raise ValueError(f'New date has {raw.size} pixels, matrix has '
+                             f'{pixels}')
+
+        if n_dates == self._buffer.shape[1]:
+            # double the capacity, so n appends copy the matrix log(n) times
+            self.release_shared()
+            grown = np.empty((pixels, max(2 * n_dates, 8)),
+                             dtype=self.matrix.dtype)
+            grown[:, :n_dates] = self.matrix
+            self._buffer = grown
+
+        # The previous last value was cleaned without a successor, redo it
+        # now that the following acquisition is known.
+        last = n_dates - 1
+        if n_dates > 1:
+            old_value = self._buffer[:, last].astype(np.float64)
+            fixed = (self._buffer[:, last - 1] + raw) / 2
+            self._buffer[:, last] = np.where(self._last_spike, fixed,
+                                             old_value)
+            delta = self._buffer[:, last] - old_value
+            self._sum_y += delta
+            self._sum_xy += last * delta
+
+        spike = (raw - self._last_raw) < threshold
+        cleaned = np.where(spike, self._buffer[:, last], raw)
+        self._buffer[:, n_dates] = cleaned
+        self.matrix = self._buffer[:, :n_dates + 1]
+        print(f'Appended {date}, {np.count_nonzero(spike)} pixels above '
+              f'threshold')
+
+        self._last_raw = raw
+        self._last_spike = spike
+
+        self._running.update(raw)
+
+        self._sum_y += cleaned
+        self._sum_xy += n_dates * cleaned
+
+        self.dates.append(date)
+        return self.matrix
+
+    def running_statistics(self):
+        """
+        Returns per-pixel mean and std rasters from the running accumulators,
+        scaled the same way as calculate()
+        """
+        statistics = self._running.result()
+        shape = (self.meta['height'], self.meta['width'])
+        mean = statistics['mean'].reshape(shape)
+        std = 10 * np.sqrt(statistics['std'].reshape(shape))
+
+        pixel_mean = RasterData(data = mean, meta = self.meta.copy(),
+                                state= RasterState.CALCULATED,
+                                rastertype= RasterType.INDEX)
+        pixel_std = RasterData(data = std, meta = self.meta.copy(),
+                               state= RasterState.CALCULATED,
+                               rastertype= RasterType.INDEX)
+        return pixel_mean, pixel_std
+
+    def _clean_data_matrix(self, data_matrix, threshold, workers = 1):
+        """
+        Smooths sudden drops (e.g. clouds) out of the data matrix
+        :param workers: processes to clean row chunks in, they attach to a
+            shared copy of the matrix instead of receiving it pickled
+        """
+        pixels = data_matrix.shape[0]
+        if workers > 1:
+            with SharedArray.from_array(data_matrix) as shared:
+                counts = run_chunked(_clean_shared_rows, pixels,
+                                     shared.handle, threshold,
+                                     workers=workers)
+                data_matrix = shared.array.copy()
+            count = sum(counts)
+        else:
+            data_matrix = data_matrix.copy()
+            count = _clean_rows(data_matrix, threshold)
+
+        print(f'Difference matrix length: {pixels}')
+        print(f'{count} pixels above threshold')
+        print(f'Portion of pixels above threshold: '
+              f'{count/data_matrix.size}')
 
         return data_matrix
 
+    def share_matrix(self, backend = 'shm'):
+        """
+        Moves the matrix buffer into shared memory, so process pools attach
+        to it instead of copying. Released by release_shared().
+        :return: SharedArrayHandle of the buffer; the matrix is the first
+            matrix.shape[1] columns
+        """
+        if self._shared is None:
+            n_dates = self.matrix.shape[1]
+            self._shared = SharedArray.from_array(self._buffer,
+                                                  backend=backend)
+            self._buffer = self._shared.array
+            self.matrix = self._buffer[:, :n_dates]
+        return self._shared.handle
+
+    def release_shared(self):
+        """Moves the matrix back to process memory and frees the segment"""
+        if self._shared is None:
+            return
+        n_dates = self.matrix.shape[1]
+        self._buffer = self._buffer.copy()
+        self.matrix = self._buffer[:, :n_dates]
+        self._shared.unlink()
+        self._shared = None
+
     def calculate_slopes(self, save_raster = False):
-        x_axis = np.arange(0, self.matrix.shape[1])
-        matrix = self.matrix.T
-        slopes = polyfit(x_axis, matrix, 1)
+        n = self.matrix.shape[1]
+        sum_x = n * (n - 1) / 2
+        sum_xx = (n - 1) * n * (2 * n - 1) / 6
+        slopes = ((n * self._sum_xy - sum_x * self._sum_y) /
+                  (n * sum_xx - sum_x ** 2))
         slope_raster = np.reshape(slopes, (self.meta['height'],
                                           self.meta['width']))
         slope_data = RasterData(data=slope_raster, meta=self.meta)
 
         if save_raster:
-            slope_data.save(f'analysis_results/{self.dates[0]}_'
-                            f'{self.dates[-1]}_slopes.tif')
+            slope_data.save(self._output_path(f'{self.index}_slopes'),
+                            **self.save_options)
+        return slope_data
 
     def create_clusters_matrix(self, n_clusters, random_state = 42,
-                               save_raster = False):
+                               save_raster = False, sample_size = None,
+                               workers = 1):
+        """
+        Clusters the pixel time series with KMeans
+        :param sample_size: fit on this many random pixels and assign the
+            rest afterwards, instead of fitting on every pixel
+        :param workers: processes assigning labels on the shared matrix
+        """
+        from sklearn.cluster import KMeans
+
         clustering = KMeans(n_clusters=n_clusters, random_state=random_state)
-        labels = clustering.fit_predict(self.matrix)
+        pixels, n_dates = self.matrix.shape
+        if sample_size is None or sample_size >= pixels:
+            labels = clustering.fit_predict(self.matrix)
+        else:
+            rng = np.random.default_rng(random_state)
+            sample = rng.choice(pixels, size=sample_size, replace=False)
+            clustering.fit(self.matrix[sample])
+            if workers > 1:
+                # only free the segment if it was not shared by the caller
+                was_shared = self._shared is not None
+                matrix_handle = self.share_matrix()
+                try:
+                    with SharedArray((pixels,), np.int32) as shared_labels:
+                        run_chunked(_assign_shared_rows, pixels,
+                                    matrix_handle, n_dates,
+                                    shared_labels.handle, clustering,
+                                    workers=workers)
+                        labels = shared_labels.array.copy()
+                finally:
+                    if not was_shared:
+                        self.release_shared()
+            else:
+                labels = clustering.predict(self.matrix)
         labels_2d = labels.reshape(
             (self.meta['height'], self.meta[
                 'width']))
@@ -149,8 +456,8 @@ class Timeseries:
             state=RasterState.CALCULATED
         )
         if save_raster:
-            cluster_raster.save(f'analysis_results/{self.dates[0]}_'
-                                f'{self.dates[-1]}_clusters.tif')
+            cluster_raster.save(self._output_path(f'{self.index}_clusters'),
+                                **self.save_options)
         return cluster_raster
 
     def fit_polynomial(self,degree = 2, save_raster = False):
@@ -0,0 +1,178 @@
+import csv
+import json
+
+import numpy as np
+from rasterio.features import rasterize
+
+from src.helper import *
+from .streaming_statistics import histogram_percentile
+
+
+class ZonalStatistics:
+    """
+    ZonalStatistics: Per-zone statistics of rasters, one date at a time
+
+    Zones come from a label raster (e.g. the create_clusters_matrix output)
+    or from rasterized polygons. The zone of every pixel is resolved once,
+    after that each raster costs one bincount per statistic, however many
+    zones there are. Percentiles are interpolated from a per-zone histogram
+    over value_range, like in StreamingStatistics.
+
+    Arguments:
+        - zones: 2D label array or RasterData with the zone of every pixel
+        - statistics: Any of count, mean, std, percentiles
+        - percentiles: Percentiles to estimate, in 0..100
+        - value_range: Range covered by the histograms
+        - bins: Number of histogram bins per zone
+        - ignore: Zone value excluded from the statistics (e.g. background)
+        - names: Optional dict of zone value to name used in the output
+    """
+
+    AVAILABLE = ('count', 'mean', 'std', 'percentiles')
+
+    def __init__(self, zones, statistics=('count', 'mean', 'std'),
+                 percentiles=(10, 50, 90), value_range=(-1, 1), bins=200,
+                 ignore=None, names=None):
+        unknown = set(statistics) - set(self.AVAILABLE)
+        if unknown:
+            raise ValueError(f'Unknown statistics {sorted(unknown)}, choose '
+                             f'from {self.AVAILABLE}')
+        if isinstance(zones, RasterData):
+            zones = zones.data
+        zones = np.asarray(zones)
+        self.shape = zones.shape
+        self.statistics = tuple(statistics)
+        self.percentiles = tuple(percentiles)
+        self.value_range = value_range
+        self.bins = bins
+        self.names = names or {}
+
+        included = np.isfinite(zones) if zones.dtype.kind == 'f' else \
+            np.ones(zones.shape, dtype=bool)
+        if ignore is not None:
+            included &= zones != ignore
+        self.zone_ids, dense = np.unique(zones[included], return_inverse=True)
+        if (self.zone_ids.dtype.kind == 'f' and
+                np.array_equal(self.zone_ids, np.round(self.zone_ids))):
+            # label rasters are saved as float32
+            self.zone_ids = self.zone_ids.astype(np.int64)
+        # excluded pixels go to an extra zone that is dropped from the output
+        self._zone_index = np.full(zones.size, len(self.zone_ids),
+                                   dtype=np.int64)
+        self._zone_index[included.ravel()] = dense.ravel()
+        self.dates = []
+        self._results = {name: [] for name in self._result_names()}
+
+    @classmethod
+    def from_polygons(cls, geometries, meta, all_touched=False, **kwargs):
+        """
+        Rasterizes polygons onto the grid of meta, later polygons win where
+        they overlap
+        :param geometries: GeoJSON-like geometries in the raster CRS
+        :param meta: profile of the rasters that will be fed in
+        :return: ZonalStatistics with zones 1..len(geometries)
+        """
+        zones = rasterize(((geometry, value) for value, geometry
+                           in enumerate(geometries, start=1)),
+                          out_shape=(int(meta['height']), int(meta['width'])),
+                          transform=meta['transform'], fill=0,
+                          all_touched=all_touched, dtype='int32')
+        return cls(zones, ignore=0, **kwargs)
+
+    @classmethod
+    def from_geojson(cls, path, meta, name_property=None, **kwargs):
+        """Zones from the features of a GeoJSON file in the raster CRS"""
+        with open(path) as file:
+            features = json.load(file)['features']
+        if name_property is not None:
+            kwargs['names'] = {value: feature['properties'][name_property]
+                               for value, feature
+                               in enumerate(features, start=1)}
+        return cls.from_polygons([feature['geometry'] for feature
+                                  in features], meta, **kwargs)
+
+    def _result_names(self):
+        names = []
+        for statistic in self.statistics:
+            if statistic == 'percentiles':
+                names.extend(f'p{q:g}' for q in self.percentiles)
+            else:
+                names.append(statistic)
+        return names
+
+    def update(self, data, date=None):
+        """
+        Adds the per-zone statistics of one raster
+        :param data: array or RasterData of the zone raster's shape
+        :param date: label of the raster in the results
+        """
+        if isinstance(data, RasterData):
+            data = data.data
+        values = np.asarray(data, dtype=np.float64).ravel()
+        if values.size != self._zone_index.size:
+            raise ValueError(f'Expected shape {self.shape} but got '
+                             f'{np.shape(data)}')
+        n_zones = len(self.zone_ids)
+        valid = np.isfinite(values)
+        index = np.where(valid, self._zone_index, n_zones)
+        values = np.where(valid, values, 0)
+
+        count = np.bincount(index, minlength=n_zones + 1)[:n_zones]
+        results = {'count': count}
+        if {'mean', 'std'} & set(self.statistics):
+            total = np.bincount(index, weights=values,
+                                minlength=n_zones + 1)[:n_zones]
+            mean = np.divide(total, count, out=np.full(n_zones, np.nan),
+                             where=count > 0)
+            results['mean'] = mean
+            if 'std' in self.statistics:
+                squares = np.bincount(index, weights=values ** 2,
+                                      minlength=n_zones + 1)[:n_zones]
+                var = np.divide(squares, count, out=np.full(n_zones, np.nan),
+                                where=count > 0) - mean ** 2
+                results['std'] = np.sqrt(np.maximum(var, 0))
+        if 'percentiles' in self.statistics:
+            low, high = self.value_range
+            bin_index = ((values - low) / (high - low) *
+                         self.bins).astype(np.int64)
+            np.clip(bin_index, 0, self.bins - 1, out=bin_index)
+            histogram = np.bincount(
+                index * self.bins + bin_index,
+                minlength=(n_zones + 1) * self.bins
+            ).reshape(n_zones + 1, self.bins)[:n_zones]
+            for q in self.percentiles:
+                results[f'p{q:g}'] = histogram_percentile(
+                    histogram, count, q, self.value_range)
+
+        for name in self._results:
+            self._results[name].append(results[name])
+        self.dates.append(date if date is not None else len(self.dates))
+
+    def result(self):
+        """
+        Returns the collected statistics
+        :return: dict of arrays shaped (dates, zones), percentiles stored as
+            'p<q>'; columns follow zone_ids
+        """
+        return {name: np.array(values).reshape(len(self.dates),
+                                               len(self.zone_ids))
+                for name, values in self._results.items()}
+
+    def curve(self, zone, statistic='mean'):
+        """Values of one zone over all dates, e.g. its recovery curve"""
+        column = np.searchsorted(self.zone_ids, zone)
+        if column == len(self.zone_ids) or self.zone_ids[column] != zone:
+            raise KeyError(f'Unknown zone {zone}')
+        return self.result()[statistic][:, column]
+
+    def save_csv(self, path):
+        """Writes one row per date and zone"""
+        results = self.result()
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['date', 'zone', 'name', *results])
+            for row, date in enumerate(self.dates):
+                for column, zone in enumerate(self.zone_ids):
+                    writer.writerow([date, zone, self.names.get(zone, ''),
+                                     *(values[row, column]
+                                       for values in results.values())])
@@ -1,2 +1,3 @@
 from .raster_data import *
 from .lookup import *
+from .shared_array import SharedArray, SharedArrayHandle, run_chunked
@@ -29,4 +29,14 @@ year2019 = [
     '20191001',
     '20191031',
     '20191130'
-]
\ No newline at end of file
+]
+
+# pixel windows (col_off, row_off, width, height) on the 10m grid of T28RBS
+windows = {
+    'lapalma': (393, 340, 3698-393, 5148-340),
+    'lavaflow_lapalma': (1209, 2591, 2510-1209, 3860-2591),
+}
+
+# scene classification (SCL) values of usable pixels: vegetation, not
+# vegetated, water, unclassified. Clouds, shadows, snow and no-data are masked.
+scl_valid = (4, 5, 6, 7)
@@ -2,10 +2,15 @@ from dataclasses import dataclass
 from enum import Enum
 import numpy as np
 import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
 from rasterio.windows import Window
 from pathlib import Path
 from typing import Any
 
+from .shared_array import SharedArray
+
 class RasterState(Enum):
     RAW = 'raw'
     CLEAN = 'clean'
@@ -49,19 +54,136 @@ class RasterData:
                     self.meta['width'] = self.window.width
                     self.meta['transform'] = rasterio.windows.transform(
                         self.window, self.meta['transform'])
+                    self._apply_scaling(src)
             else:
                 with rasterio.open(self.source) as src:
                     self.data = src.read(1)
                     self.meta = src.profile.copy()
                     self.bounds = src.bounds
+                    self._apply_scaling(src)
         self.meta['driver'] = 'GTiff'
         self.meta['dtype'] = 'float32'
-    def save(self, path: str | Path):
-        """Saves the raster data to a file using the stored metadata"""
-        results_folder = Path('results')
+
+    def _apply_scaling(self, src):
+        """Decodes rasters saved with scale_factor back to float values"""
+        scale, offset = src.scales[0], src.offsets[0]
+        if scale == 1 and offset == 0:
+            return
+        data = self.data.astype(np.float32)
+        if src.nodata is not None:
+            data[self.data == src.nodata] = np.nan
+        self.data = data * scale + offset
+        self.meta['nodata'] = np.nan
+
+    def share(self, backend: str = 'shm') -> SharedArray:
+        """
+        Moves data into shared memory, so process pools can attach to it
+        through the returned array's handle instead of pickling it. Release
+        the segment with release_shared(), which keeps a copy of the data.
+        """
+        if getattr(self, '_shared', None) is None:
+            self._shared = SharedArray.from_array(self.data, backend=backend)
+            self.data = self._shared.array
+        return self._shared
+
+    def release_shared(self):
+        """Moves data back to process memory and frees the segment"""
+        shared = getattr(self, '_shared', None)
+        if shared is None:
+            return
+        self.data = self.data.copy()
+        shared.unlink()
+        self._shared = None
+
+    def save(self, path: str | Path, results_folder: str | Path = 'results',
+             compress: str = None, level: int = None, predictor: int = None,
+             tiled: bool = False, blocksize: int = 512,
+             overviews: tuple[int, ...] = None, cog: bool = False,
+             scale_factor: float = None, num_threads: str = 'ALL_CPUS'):
+        """
+        Saves the raster data to a file using the stored metadata
+        :param path: file path, relative to results_folder
+        :param results_folder: folder prefixed to path, None to use path as is
+        :param compress: 'deflate', 'zstd', 'lzw' or None for uncompressed
+        :param level: compression level of deflate/zstd
+        :param predictor: 2 (integers) or 3 (floats), chosen from the dtype
+            when compress is set and predictor is None
+        :param tiled: write internal tiles of blocksize x blocksize
+        :param overviews: overview factors to build, e.g. (2, 4, 8, 16)
+        :param cog: write a cloud optimized GeoTIFF (tiled, with overviews)
+        :param scale_factor: store round(data * scale_factor) as int16 with
+            nodata -32768; the scale is written to the file and undone when
+            read back through RasterData
+        :param num_threads: GDAL threads used for compression
+        """
+        if results_folder is not None:
+            path = Path(results_folder) / path
         print(f'Trying to save to {path}')
+
+        profile = self.meta.copy()
+        for key in ('blockxsize', 'blockysize', 'tiled', 'compress',
+                    'predictor', 'interleave', 'photometric'):
+            profile.pop(key, None)
+        profile.update({'driver': 'GTiff', 'count': 1})
+
+        data = self.data
+        if scale_factor is not None:
+            nodata = np.iinfo(np.int16).min
+            scaled = np.round(np.asarray(data, dtype=np.float64) *
+                              scale_factor)
+            scaled = np.clip(scaled, nodata + 1, np.iinfo(np.int16).max)
+            data = np.where(np.isfinite(scaled), scaled, nodata).astype(np.int16)
+            profile.update({'dtype': 'int16', 'nodata': nodata})
+
+        options = {}
+        if tiled or cog:
+            options.update({'tiled': True, 'blockxsize': blocksize,
+                            'blockysize': blocksize})
+        if compress is not None:
+            if predictor is None:
+                predictor = (2 if np.issubdtype(np.dtype(profile['dtype']),
+                                                np.integer) else 3)
+            options.update({'compress': compress, 'predictor': predictor,
+                            'num_threads': num_threads})
+            if level is not None:
+                level_key = 'zstd_level' if compress.lower() == 'zstd' else 'zlevel'
+                options[level_key] = level
+
         try:
-            with rasterio.open(results_folder / path, 'w', **self.meta) as dst:
-                dst.write(self.data, 1)
+            if cog:
+                self._save_cog(path, data, profile, options, scale_factor,
+                               blocksize)
+            else:
+                profile.update(options)
+                with rasterio.open(path, 'w', **profile) as dst:
+                    dst.write(data, 1)
+                    if scale_factor is not None:
+                        dst.scales = (1 / scale_factor,)
+                    if overviews:
+                        dst.build_overviews(list(overviews),
+                                            Resampling.average)
+                        dst.update_tags(ns='rio_overview',
+                                        resampling='average')
         except Exception as e:
             print(f'Failed to save to {path}: {e}')
+
+    def _save_cog(self, path, data, profile, options, scale_factor,
+                  blocksize):
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as staging:
+                staging.write(data, 1)
+                if scale_factor is not None:
+                    staging.scales = (1 / scale_factor,)
+            with memfile.open() as staging:
+                cog_options = {key: value for key, value in options.items()
+                               if key not in ('tiled', 'blockxsize',
+                                              'blockysize', 'zlevel',
+                                              'zstd_level')}
+                # the COG driver takes a single LEVEL option for all codecs
+                for key in ('zlevel', 'zstd_level'):
+                    if key in options:
+                        cog_options['level'] = options[key]
+                rasterio.shutil.copy(staging, path, driver='COG',
+                                     blocksize=blocksize,
+                                     overview_resampling='average',
+                                     **cog_options)
@@ -0,0 +1,193 @@
+import atexit
+import os
+import sys
+import tempfile
+import uuid
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class SharedArrayHandle:
+    """Picklable description of a SharedArray, sent to workers instead of data"""
+    name: str
+    shape: tuple
+    dtype: str
+    backend: str = 'shm'
+
+    def attach(self):
+        return SharedArray(self.shape, self.dtype, backend=self.backend,
+                           name=self.name)
+
+
+class SharedArray:
+    """
+    SharedArray: numpy array in shared memory or a memory-mapped file
+
+    The creating process owns the segment and has to release it with
+    unlink() (or use it as a context manager); segments still owned at
+    interpreter exit are released automatically. Workers attach through the
+    handle and only close() their mapping.
+
+    Arguments:
+        - shape: Shape of the array
+        - dtype: numpy dtype
+        - backend: 'shm' (multiprocessing.shared_memory) or 'memmap' (file in
+          directory, for arrays larger than the shared memory filesystem)
+        - directory: Directory of memmap files, defaults to the temp dir
+        - name: Attach to an existing segment instead of creating one
+    """
+
+    _owned = {}
+
+    def __init__(self, shape, dtype=np.float64, backend='shm',
+                 directory=None, name=None):
+        if backend not in ('shm', 'memmap'):
+            raise ValueError(f'Unknown backend {backend}, use shm or memmap')
+        self.shape = tuple(int(size) for size in shape)
+        self.dtype = np.dtype(dtype)
+        self.backend = backend
+        self.owner = name is None
+        self._pid = os.getpid()
+        self._shm = None
+        nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+
+        if backend == 'shm':
+            if self.owner:
+                self._shm = shared_memory.SharedMemory(create=True,
+                                                       size=nbytes)
+            else:
+                self._shm = _attach_shared_memory(name)
+            self.name = self._shm.name
+            self._array = np.ndarray(self.shape, dtype=self.dtype,
+                                     buffer=self._shm.buf)
+        else:
+            if self.owner:
+                directory = Path(directory or tempfile.gettempdir())
+                name = str(directory / f'shared_{uuid.uuid4().hex}.npy')
+            self.name = name
+            self._array = np.lib.format.open_memmap(
+                name, mode='w+' if self.owner else 'r+', dtype=self.dtype,
+                shape=self.shape)
+
+        if self.owner:
+            SharedArray._owned[self.name] = self
+
+    @classmethod
+    def from_array(cls, array, backend='shm', directory=None):
+        """Copies an array into a new shared segment"""
+        shared = cls(array.shape, array.dtype, backend=backend,
+                     directory=directory)
+        shared.array[...] = array
+        return shared
+
+    @property
+    def array(self):
+        if self._array is None:
+            raise ValueError(f'Shared array {self.name} is closed')
+        return self._array
+
+    @property
+    def handle(self):
+        return SharedArrayHandle(self.name, self.shape, self.dtype.str,
+                                 self.backend)
+
+    def close(self):
+        """Releases the mapping in this process"""
+        if self._array is None:
+            return
+        # numpy holds no buffer export on the mapping, so closing it under
+        # live views would leave them dangling. Views keep a reference to
+        # self._array, which otherwise only has this attribute and the
+        # getrefcount argument.
+        if sys.getrefcount(self._array) > 2:
+            raise ValueError(f'Cannot close shared array {self.name} '
+                             f'while numpy views of it are alive')
+        base = self._array._mmap if self.backend == 'memmap' else None
+        self._array = None
+        if self.backend == 'memmap':
+            base.flush()
+            base.close()
+        else:
+            self._shm.close()
+
+    def unlink(self):
+        """Closes and removes the segment, only allowed for the owner"""
+        if not self.owner:
+            raise ValueError('Only the creating process can unlink '
+                             f'{self.name}')
+        self.close()
+        self._remove()
+
+    def _remove(self):
+        """Removes the segment name; existing mappings stay valid"""
+        if SharedArray._owned.pop(self.name, None) is None:
+            return
+        if self.backend == 'shm':
+            self._shm.unlink()
+        elif os.path.exists(self.name):
+            os.remove(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
+
+
+def _attach_shared_memory(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 attaching registers the segment again; pool workers share
+    # the resource tracker of the creating process, so this is a no-op there
+    return shared_memory.SharedMemory(name=name)
+
+
+@atexit.register
+def _release_owned():
+    for shared in list(SharedArray._owned.values()):
+        if shared._pid != os.getpid():
+            continue
+        try:
+            shared.unlink()
+        except ValueError:
+            # views are still alive, so the mapping cannot be closed; the
+            # segment is removed anyway and freed when the process ends
+            warnings.warn(f'Shared array {shared.name} was not released '
+                          f'before exit, call unlink() when done with it',
+                          RuntimeWarning)
+            shared._remove()
+
+
+def row_chunks(n_rows, workers, chunk_rows=None):
+    """Splits range(n_rows) into (start, stop) pairs"""
+    if chunk_rows is None:
+        chunk_rows = -(-n_rows // (4 * workers))
+    chunk_rows = max(int(chunk_rows), 1)
+    return [(start, min(start + chunk_rows, n_rows))
+            for start in range(0, n_rows, chunk_rows)]
+
+
+def run_chunked(worker, n_rows, *args, workers=None, chunk_rows=None):
+    """
+    Runs worker(start, stop, *args) for row chunks across a process pool
+    :param worker: module level function; pass SharedArrayHandles in args
+        and attach inside the worker instead of passing arrays
+    :return: list of worker results in chunk order
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = row_chunks(n_rows, workers, chunk_rows)
+    if workers == 1:
+        return [worker(start, stop, *args) for start, stop in chunks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker, start, stop, *args)
+                   for start, stop in chunks]
+        return [future.result() for future in futures]
@@ -1 +1,25 @@
-from .visualizer import Visualizer
\ No newline at end of file
+from importlib import import_module
+
+# matplotlib and pyvista are only imported once the class using them is
+# accessed.
+_exports = {
+    'Visualizer': '.visualizer',
+    'BatchRenderer': '.batch_renderer',
+    'render_batch': '.batch_renderer',
+    'atlas_jobs': '.batch_renderer',
+    'TerrainBuilder': '.terrain',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
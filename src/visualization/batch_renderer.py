@@ -0,0 +1,140 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
+
+from .visualizer import Visualizer
+
+
+class BatchRenderer(Visualizer):
+    """
+    BatchRenderer: Headless figure export for many rasters
+
+    Draws on Agg canvases without pyplot, so nothing is shown and no global
+    figure state is kept. One figure, image and colorbar is created per
+    colormap style and reused: each render only swaps the image data,
+    extent, color limits and title before saving.
+
+    Arguments:
+        - output_dir: Directory the PNG files are written to
+        - figsize: Figure size in inches
+        - dpi: Output resolution
+    """
+
+    def __init__(self, output_dir='results/figures', figsize=(10, 8),
+                 dpi=100):
+        super().__init__()
+        self.output_dir = Path(output_dir)
+        self.figsize = figsize
+        self.dpi = dpi
+        self._figures = {}
+
+    def _figure(self, index, discrete, categorical):
+        key = (index, discrete, categorical)
+        if key not in self._figures:
+            fig = Figure(figsize=self.figsize, dpi=self.dpi)
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            placeholder = np.zeros((2, 2), dtype=np.float32)
+            if discrete:
+                im = ax.imshow(placeholder,
+                               cmap=ListedColormap(self.discrete_colors),
+                               norm=self.discrete_norm)
+            else:
+                im = ax.imshow(placeholder, cmap=self.colormaps[index],
+                               vmin=-1, vmax=1,
+                               interpolation='nearest' if categorical
+                               else 'antialiased')
+            fig.colorbar(im, ax=ax)
+            self._figures[key] = (fig, ax, im)
+        return self._figures[key]
+
+    def render(self, data, name, index='default', title=None,
+               discrete=False, categorical=False, band=1, vmin=None,
+               vmax=None):
+        """
+        Renders one raster to <output_dir>/<name>.png
+        :param data: numpy array, path or file path string
+        :param vmin, vmax: color limits, default -1..1 (data range for
+            categorical rasters)
+        :return: path of the written file
+        """
+        if not isinstance(data, np.ndarray):
+            data = Path(data)
+        fig, ax, im = self._figure(index, discrete, categorical)
+        level = self._level_for_axes(data, band, ax, categorical)
+
+        im.set_data(level)
+        im.set_extent(self._full_extent(data))
+        if not discrete:
+            if categorical and vmin is None and vmax is None:
+                vmin, vmax = np.nanmin(level), np.nanmax(level)
+            im.set_clim(-1 if vmin is None else vmin,
+                        1 if vmax is None else vmax)
+        ax.set_title(title or '')
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        output_path = self.output_dir / f'{name}.png'
+        fig.savefig(output_path, dpi=self.dpi)
+        # do not keep every rendered array alive through the pyramid cache
+        self.clear_cache()
+        return output_path
+
+    def render_many(self, jobs):
+        """Renders a list of job dicts, see render for the keys"""
+        paths = []
+        for counter, job in enumerate(jobs, start=1):
+            paths.append(self.render(**job))
+            print(f'Rendered {counter}/{len(jobs)}: {job["name"]}')
+        return paths
+
+
+def _render_chunk(jobs, renderer_kwargs):
+    renderer = BatchRenderer(**renderer_kwargs)
+    return [renderer.render(**job) for job in jobs]
+
+
+def render_batch(jobs, workers=None, **renderer_kwargs):
+    """
+    Renders jobs across a process pool, each worker reusing its own figures
+    :param jobs: list of dicts with the arguments of BatchRenderer.render;
+        pass file paths rather than arrays to avoid pickling rasters
+    :param workers: number of processes, defaults to the CPU count
+    :return: list of written paths, in job order
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        return BatchRenderer(**renderer_kwargs).render_many(jobs)
+
+    # contiguous chunks, so every worker reuses its figures across many jobs
+    chunk_size = -(-len(jobs) // workers)
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    paths = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_render_chunk, chunk, renderer_kwargs)
+                   for chunk in chunks]
+        for counter, future in enumerate(futures, start=1):
+            paths.extend(future.result())
+            print(f'Rendered chunk {counter}/{len(chunks)} '
+                  f'({len(paths)}/{len(jobs)} figures)')
+    return paths
+
+
+def atlas_jobs(directory, pattern='*.tif'):
+    """
+    Builds render jobs for every raster in a directory, choosing the style
+    from the file name suffix (_savi, _mean, _std, _clusters, ...)
+    """
+    visualizer_colormaps = Visualizer().colormaps
+    jobs = []
+    for path in sorted(Path(directory).glob(pattern)):
+        suffix = path.stem.split('_')[-1]
+        index = suffix if suffix in visualizer_colormaps else 'default'
+        jobs.append({'data': str(path), 'name': path.stem,
+                     'title': path.stem, 'index': index,
+                     'categorical': suffix == 'clusters'})
+    return jobs
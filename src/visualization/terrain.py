@@ -0,0 +1,147 @@
+from pathlib import Path
+
+import numpy as np
+import pyvista as pv
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+
+
+class TerrainBuilder:
+    """
+    TerrainBuilder: Multi-resolution 3D terrain meshes from a DEM
+
+    Levels are built on uniform grids (pv.ImageData), so only the elevation
+    values are stored and no coordinate meshgrids are created. Level k uses
+    every 2**k-th DEM pixel; meshes and draped rasters are cached per level.
+
+    Arguments:
+        - elevation: 2D elevation array
+        - meta: Raster profile of the elevation data
+        - z_scale: Vertical exaggeration relative to the pixel spacing
+        - max_points: Point budget used to pick the level automatically
+    """
+
+    def __init__(self, elevation, meta, z_scale=0.05, max_points=2_000_000):
+        elevation = np.asarray(elevation, dtype=np.float32)
+        if not np.isfinite(elevation).all():
+            elevation = elevation.copy()
+            elevation[~np.isfinite(elevation)] = np.nanmean(elevation)
+        self.elevation = elevation
+        self.meta = meta
+        self.z_scale = z_scale
+        self.max_points = max_points
+        self._meshes = {}
+        self._drape_sources = {}
+        self._drapes = {}
+
+    @classmethod
+    def from_file(cls, source_path, window=None, **kwargs):
+        """Reads a DEM (relative to the project root) into a TerrainBuilder"""
+        dem_path = Path(__file__).parents[2] / source_path
+        with rasterio.open(dem_path) as src:
+            data = src.read(1, window=window)
+            meta = src.profile.copy()
+            if window is not None:
+                meta['height'], meta['width'] = data.shape
+                meta['transform'] = src.window_transform(window)
+        return cls(data, meta, **kwargs)
+
+    def level_shape(self, level):
+        step = 2 ** level
+        rows, cols = self.elevation.shape
+        return -(-rows // step), -(-cols // step)
+
+    def auto_level(self):
+        """Finest level whose point count fits into max_points"""
+        level = 0
+        while np.prod(self.level_shape(level)) > self.max_points:
+            level += 1
+        return level
+
+    def mesh(self, level=None):
+        """
+        Returns the warped terrain surface of a level
+        :param level: decimation level, None picks auto_level()
+        :return: pv.StructuredGrid with 'elevation' point data
+        """
+        if level is None:
+            level = self.auto_level()
+        if level not in self._meshes:
+            step = 2 ** level
+            data = self.elevation[::step, ::step]
+            rows, cols = data.shape
+            grid = pv.ImageData(dimensions=(cols, rows, 1),
+                                spacing=(step, step, 1))
+            # ImageData points run x fastest, matching a C-ordered ravel
+            grid.point_data['elevation'] = data.ravel()
+            self._meshes[level] = grid.warp_by_scalar('elevation',
+                                                      factor=self.z_scale)
+        return self._meshes[level]
+
+    def drape(self, name, color_data, color_meta, level=None):
+        """
+        Resamples a raster onto a level and attaches it as point data
+        :param name: name of the scalars on the mesh
+        :param color_data: 2D array covering the same extent as the DEM
+        :param color_meta: profile of color_data
+        :return: the mesh with the draped scalars
+        """
+        if level is None:
+            level = self.auto_level()
+        mesh = self.mesh(level)
+        shape = self.level_shape(level)
+
+        if name not in self._drape_sources:
+            # keep the source in an open in-memory GeoTIFF, so every level is
+            # a decimated read instead of a new write
+            color_data = np.asarray(color_data)
+            memfile = MemoryFile()
+            dataset = memfile.open(driver='GTiff',
+                                   height=color_data.shape[0],
+                                   width=color_data.shape[1], count=1,
+                                   dtype=color_data.dtype,
+                                   crs=color_meta.get('crs'),
+                                   transform=color_meta['transform'])
+            dataset.write(color_data, 1)
+            self._drape_sources[name] = (memfile, dataset)
+
+        key = (name, level)
+        if key not in self._drapes:
+            dataset = self._drape_sources[name][1]
+            self._drapes[key] = dataset.read(1, out_shape=shape,
+                                             resampling=Resampling.average)
+        mesh.point_data[name] = self._drapes[key].ravel()
+        return mesh
+
+    def plot(self, scalars='elevation', level=None, cmap='terrain',
+             clim=None, off_screen=False, screenshot=None,
+             window_size=(1920, 1080)):
+        """
+        Shows the terrain, or renders it off-screen to a screenshot
+        :param scalars: 'elevation' or the name of a draped raster
+        :param screenshot: optional output path of an image
+        """
+        mesh = self.mesh(level)
+        if clim is None:
+            values = mesh.point_data[scalars]
+            clim = [float(values.min()), float(values.max())]
+
+        p = pv.Plotter(off_screen=off_screen or screenshot is not None,
+                       window_size=list(window_size))
+        p.add_mesh(mesh, scalars=scalars, cmap=cmap, clim=clim,
+                   lighting=True)
+        p.add_scalar_bar(scalars)
+        if screenshot is not None:
+            p.screenshot(str(screenshot))
+            p.close()
+        else:
+            p.add_axes(interactive=True)
+            p.show()
+
+    def close(self):
+        for memfile, dataset in self._drape_sources.values():
+            dataset.close()
+            memfile.close()
+        self._drape_sources = {}
+        self._drapes = {}
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from pathlib import Path
 from typing import Type
 
@@ -5,6 +6,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import rasterio
 from matplotlib.colors import BoundaryNorm, ListedColormap
+from rasterio.enums import Resampling
 
 
 
@@ -17,7 +19,8 @@ class Visualizer:
             'nbr': 'RdYlBu',
             'default': 'viridis',
             'std': 'magma',
-            'mean': 'RdYlGn'
+            'mean': 'RdYlGn',
+            'clusters': 'tab10'
         }
 
         self.discrete_bounds = [-1, 0, 0.2, 0.4, 0.6, 0.8, 1]
@@ -32,6 +35,18 @@ class Visualizer:
             'figsize': (20, 8)
         }
 
+        # level shapes and decimated reads of files, keyed by path,
+        # modification time and size so rewritten files are read again
+        self.max_cached_levels = 8
+        self._pyramids = OrderedDict()
+        self.min_level_size = 256
+        # Array pyramids are rebuilt on every plot unless cache_arrays is
+        # set. Cached pyramids are keyed on the array object and do not see
+        # in-place changes, call clear_cache() after modifying an array.
+        self.cache_arrays = False
+        self.max_cached_arrays = 4
+        self._array_pyramids = OrderedDict()
+
     def _read_data(self, data: str | Path | np.ndarray,
                    band: int = 1) -> np.ndarray:
         if isinstance(data, Path):
@@ -48,21 +63,153 @@ class Visualizer:
         else:
             print('Data has to be Path, file_path string or numpy array!')
 
+    def _block_mean(self, data: np.ndarray) -> np.ndarray:
+        rows = -(-data.shape[0] // 2)
+        cols = -(-data.shape[1] // 2)
+        padded = np.full((rows * 2, cols * 2), np.nan, dtype=np.float32)
+        padded[:data.shape[0], :data.shape[1]] = data
+        blocks = padded.reshape(rows, 2, cols, 2)
+        valid = np.isfinite(blocks).sum(axis=(1, 3))
+        sums = np.nansum(blocks, axis=(1, 3))
+        return np.divide(sums, valid, out=np.full((rows, cols), np.nan,
+                                                  dtype=np.float32),
+                         where=valid > 0)
+
+    def build_pyramid(self, data: np.ndarray,
+                      categorical: bool = False) -> list[np.ndarray]:
+        """
+        Builds decimated levels of an array, halving the size each level
+        until it is smaller than min_level_size. Categorical data
+        (classes, cluster labels) is decimated by striding instead of averaging.
+        """
+        levels = [data]
+        while max(levels[-1].shape) > self.min_level_size:
+            if categorical:
+                levels.append(levels[-1][::2, ::2])
+            else:
+                levels.append(self._block_mean(levels[-1]))
+        return levels
+
+    def _pyramid(self, data: str | Path | np.ndarray, band: int,
+                 categorical: bool) -> list:
+        if isinstance(data, np.ndarray):
+            if not self.cache_arrays:
+                return self.build_pyramid(data, categorical)
+            key = (id(data), categorical)
+            cached = self._array_pyramids.get(key)
+            # the stored array guards against a reused id of a freed one
+            if cached is None or cached[0] is not data:
+                cached = (data, self.build_pyramid(data, categorical))
+                self._array_pyramids[key] = cached
+                while len(self._array_pyramids) > self.max_cached_arrays:
+                    self._array_pyramids.popitem(last=False)
+            else:
+                self._array_pyramids.move_to_end(key)
+            return cached[1]
+
+        key = ('file', *self._file_key(data), band, categorical)
+        if key not in self._pyramids:
+            with rasterio.open(data) as src:
+                shape = (src.height, src.width)
+            levels = [shape]
+            while max(levels[-1]) > self.min_level_size:
+                levels.append((-(-levels[-1][0] // 2), -(-levels[-1][1] // 2)))
+            # levels of a file are read lazily, using internal overviews
+            # where the file has them
+            self._cache_file_entry(key, levels)
+        else:
+            self._pyramids.move_to_end(key)
+        return self._pyramids[key][1]
+
+    @staticmethod
+    def _file_key(data: str | Path) -> tuple:
+        path = Path(data)
+        stat = path.stat()
+        return str(path), stat.st_mtime_ns, stat.st_size
+
+    def _cache_file_entry(self, key: tuple, value):
+        self._pyramids[key] = (None, value)
+        while len(self._pyramids) > self.max_cached_levels:
+            self._pyramids.popitem(last=False)
+
+    def _read_level(self, data: str | Path, band: int, shape: tuple,
+                    categorical: bool) -> np.ndarray:
+        key = ('level', *self._file_key(data), band, shape, categorical)
+        if key not in self._pyramids:
+            resampling = (Resampling.nearest if categorical
+                          else Resampling.average)
+            with rasterio.open(data) as src:
+                level = src.read(band, out_shape=shape, resampling=resampling)
+            self._cache_file_entry(key, level)
+        else:
+            self._pyramids.move_to_end(key)
+        return self._pyramids[key][1]
+
+    def _level_for_axes(self, data: str | Path | np.ndarray, band: int,
+                        ax: plt.Axes, categorical: bool = False) -> np.ndarray:
+        """
+        Returns the coarsest pyramid level that still has at least one data
+        pixel per screen pixel of the axes
+        """
+        bbox = ax.get_window_extent()
+        width_px, height_px = bbox.width, bbox.height
+
+        levels = self._pyramid(data, band, categorical)
+        selected = levels[0]
+        for level in levels:
+            shape = level.shape if isinstance(level, np.ndarray) else level
+            if shape[0] < height_px or shape[1] < width_px:
+                break
+            selected = level
+
+        if isinstance(selected, np.ndarray):
+            return selected
+        return self._read_level(data, band, selected, categorical)
+
+    def clear_cache(self):
+        self._pyramids = OrderedDict()
+        self._array_pyramids = OrderedDict()
+
+    def build_overviews(self, path: str | Path,
+                        factors: tuple[int, ...] = (2, 4, 8, 16),
+                        categorical: bool = False):
+        """Writes internal overviews into a GeoTIFF for fast decimated reads"""
+        resampling = Resampling.nearest if categorical else Resampling.average
+        with rasterio.open(path, 'r+') as dst:
+            dst.build_overviews(list(factors), resampling)
+            dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+    def _full_extent(self, data: str | Path | np.ndarray) -> tuple:
+        if isinstance(data, np.ndarray):
+            rows, cols = data.shape
+        else:
+            with rasterio.open(data) as src:
+                rows, cols = src.height, src.width
+        return (0, cols, rows, 0)
+
     def simple_plot(self, data: str | Path | np.ndarray, band: int = 1,
                     title: str = None, index: str = 'default',
-                    discrete: bool = False) -> plt.Figure:
+                    discrete: bool = False,
+                    categorical: bool = False,
+                    show: bool = True) -> plt.Figure:
         fig, ax = plt.subplots(**self.default_style)
+        if not isinstance(data, np.ndarray):
+            data = Path(data)
+        level = self._level_for_axes(data, band, ax, categorical)
+        extent = self._full_extent(data)
         if discrete:
-            im = ax.imshow(data, cmap=ListedColormap(self.discrete_colors),
-                           norm=self.discrete_norm)
+            im = ax.imshow(level, cmap=ListedColormap(self.discrete_colors),
+                           norm=self.discrete_norm, extent=extent)
         else:
-            im = ax.imshow(data, cmap=self.colormaps[index], vmin=-1, vmax=1)
+            im = ax.imshow(level, cmap=self.colormaps[index], vmin=-1, vmax=1,
+                           extent=extent)
 
         plt.colorbar(im, ax=ax)
 
         if title:
             plt.title(title)
-        plt.show()
+        if show:
+            plt.show()
         return fig
 
     def compare_plots(self,
@@ -71,21 +218,32 @@ class Visualizer:
                       band: int = 1,
                       titles: tuple[str, str] = None,
                       index: str = 'default',
-                      discrete: bool = False) \
+                      discrete: bool = False,
+                      categorical: bool = False,
+                      show: bool = True) \
             -> plt.Figure:
-        data1 = self._read_data(data1, band)
-        data2 = self._read_data(data2, band)
+        if not isinstance(data1, np.ndarray):
+            data1 = Path(data1)
+        if not isinstance(data2, np.ndarray):
+            data2 = Path(data2)
 
         fig, (ax1, ax2) = plt.subplots(1, 2, **self.comp_style)
 
+        level1 = self._level_for_axes(data1, band, ax1, categorical)
+        level2 = self._level_for_axes(data2, band, ax2, categorical)
+        extent1 = self._full_extent(data1)
+        extent2 = self._full_extent(data2)
+
         if discrete:
-            im1 = ax1.imshow(data1, cmap=ListedColormap(self.discrete_colors),
-                             norm=self.discrete_norm)
-            im2 = ax2.imshow(data2, cmap=ListedColormap(self.discrete_colors),
-                             norm=self.discrete_norm)
+            im1 = ax1.imshow(level1, cmap=ListedColormap(self.discrete_colors),
+                             norm=self.discrete_norm, extent=extent1)
+            im2 = ax2.imshow(level2, cmap=ListedColormap(self.discrete_colors),
+                             norm=self.discrete_norm, extent=extent2)
         else:
-            im1 = ax1.imshow(data1, cmap=self.colormaps[index], vmin=-1, vmax=1)
-            im2 = ax2.imshow(data2, cmap=self.colormaps[index], vmin=-1, vmax=1)
+            im1 = ax1.imshow(level1, cmap=self.colormaps[index], vmin=-1,
+                             vmax=1, extent=extent1)
+            im2 = ax2.imshow(level2, cmap=self.colormaps[index], vmin=-1,
+                             vmax=1, extent=extent2)
 
         plt.colorbar(im1, ax=ax1)
         plt.colorbar(im2, ax=ax2)
@@ -93,7 +251,8 @@ class Visualizer:
         if titles:
             ax1.set_title(titles[0])
             ax2.set_title(titles[1])
-        plt.show()
+        if show:
+            plt.show()
         return fig
 
     def subsampling(self, data:np.array, size: int) -> np.ndarray:
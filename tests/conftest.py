@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the package is imported as src, from the project root
+sys.path.insert(0, str(Path(__file__).parents[1]))
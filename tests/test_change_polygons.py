@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from scipy import ndimage
+
+from src.data_processing import ChangeDetector
+
+HEIGHT, WIDTH = 101, 77
+
+
+@pytest.fixture
+def change_rasters(tmp_path):
+    rng = np.random.default_rng(3)
+    # smoothed noise gives patches of many shapes, most cross block seams
+    mask = ndimage.uniform_filter(rng.random((HEIGHT, WIDTH)), 5) > 0.52
+    difference = rng.normal(0.3, 0.1, (HEIGHT, WIDTH)).astype(np.float32)
+    difference[rng.random((HEIGHT, WIDTH)) < 0.02] = np.nan
+    profile = {'driver': 'GTiff', 'width': WIDTH, 'height': HEIGHT,
+               'count': 1, 'crs': 'EPSG:32628',
+               'transform': from_origin(200000, 3200000, 10, 10),
+               'tiled': True, 'blockxsize': 16, 'blockysize': 16}
+    paths = {'mask': tmp_path / 'mask.tif',
+             'difference': tmp_path / 'difference.tif'}
+    with rasterio.open(paths['mask'], 'w', dtype='uint8', **profile) as dst:
+        dst.write(mask.astype(np.uint8), 1)
+    with rasterio.open(paths['difference'], 'w', dtype='float32',
+                       nodata=np.nan, **profile) as dst:
+        dst.write(difference, 1)
+    return paths, mask, difference
+
+
+def _full_raster_patches(mask, difference, min_pixels):
+    labels, count = ndimage.label(mask, structure=np.ones((3, 3)))
+    valid = np.isfinite(difference)
+    patches = []
+    for label in range(1, count + 1):
+        values = difference[(labels == label) & valid]
+        if len(values) >= min_pixels:
+            patches.append((len(values), values.astype(np.float64).mean()))
+    return sorted(patches)
+
+
+@pytest.mark.parametrize('block_size', [16, 32, 512])
+def test_block_labels_match_full_raster(change_rasters, tmp_path, block_size):
+    paths, mask, difference = change_rasters
+    detector = ChangeDetector('T28RBS', output_dir=tmp_path,
+                              block_size=block_size)
+    polygons = detector.change_polygons(paths, min_pixels=3)
+
+    expected = _full_raster_patches(mask, difference, 3)
+    patches = sorted((polygon['pixels'], polygon['mean'])
+                     for polygon in polygons)
+    assert len(patches) == len(expected)
+    assert [pixels for pixels, _ in patches] == \
+        [pixels for pixels, _ in expected]
+    np.testing.assert_allclose([mean for _, mean in patches],
+                               [mean for _, mean in expected], rtol=1e-12)
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parents[1]
+# measured about 0.16 s; the budget leaves room for slower machines
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ('sklearn', 'scipy', 'matplotlib', 'pyvista')
+
+SCRIPT = '''
+import sys
+import time
+start = time.perf_counter()
+import src.data_processing, src.visualization
+print(time.perf_counter() - start)
+print(' '.join(name for name in {heavy!r}
+               if name in sys.modules))
+'''
+
+
+def test_import_time():
+    result = subprocess.run(
+        [sys.executable, '-c', SCRIPT.format(heavy=HEAVY_MODULES)],
+        cwd=PROJECT_ROOT, capture_output=True, text=True, check=True)
+    elapsed, loaded = (result.stdout.splitlines() + [''])[:2]
+    assert float(elapsed) < IMPORT_BUDGET
+    assert loaded == ''
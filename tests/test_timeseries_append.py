@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from rasterio.transform import from_origin
+
+from src.data_processing import Timeseries
+from src.helper import RasterData, RasterState, RasterType
+
+HEIGHT, WIDTH = 12, 9
+DATES = [f'201901{day:02d}' for day in range(1, 12)]
+
+
+def _index_stack():
+    rng = np.random.default_rng(7)
+    stack = rng.uniform(0.1, 0.6, (len(DATES), HEIGHT, WIDTH))
+    # cloud-like drops, some of them on consecutive or the last dates
+    drops = rng.random(stack.shape) < 0.2
+    stack[drops] -= rng.uniform(0.3, 0.6, np.count_nonzero(drops))
+    return stack.astype(np.float32)
+
+
+class SyntheticTimeseries(Timeseries):
+    """Timeseries reading the index from an in-memory stack"""
+
+    stack = _index_stack()
+
+    def _calculate_index(self, index, date):
+        meta = {'height': HEIGHT, 'width': WIDTH, 'count': 1,
+                'crs': 'EPSG:32628',
+                'transform': from_origin(200000, 3200000, 10, 10)}
+        return RasterData(data = self.stack[DATES.index(date)].copy(),
+                          meta = meta, state = RasterState.CALCULATED,
+                          rastertype = RasterType.INDEX)
+
+
+@pytest.mark.parametrize('initial', [1, 2, 5])
+def test_append_matches_rebuild(initial):
+    bounds = (0, 0, WIDTH, HEIGHT)
+    rebuilt = SyntheticTimeseries('T28RBS', DATES, bounds=bounds)
+    rebuilt.create_timeseries_matrix('savi')
+
+    appended = SyntheticTimeseries('T28RBS', DATES[:initial], bounds=bounds)
+    appended.create_timeseries_matrix('savi')
+    for date in DATES[initial:]:
+        appended.append(date)
+
+    assert appended.dates == DATES
+    np.testing.assert_array_equal(appended.matrix, rebuilt.matrix)
+    np.testing.assert_allclose(appended.calculate_slopes().data,
+                               rebuilt.calculate_slopes().data, rtol=1e-12)
+    for running, expected in zip(appended.running_statistics(),
+                                 rebuilt.running_statistics()):
+        np.testing.assert_allclose(running.data, expected.data, rtol=1e-12)
+
+
+def test_matrix_has_no_spare_columns():
+    timeseries = SyntheticTimeseries('T28RBS', DATES[:3],
+                                     bounds=(0, 0, WIDTH, HEIGHT))
+    timeseries.create_timeseries_matrix('savi')
+    assert timeseries._buffer.shape == (HEIGHT * WIDTH, 3)